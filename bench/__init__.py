@@ -0,0 +1,8 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+# Benchmarks for the server, run from the top of the source tree; not
+# installed with the jim package
@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+# Times the Database methods that the server leans on, against leagues of
+# different sizes built by bench.generate, and writes the results as JSON so
+# that runs before and after a change can be compared. Methods that the
+# server answers from the snapshot cache are timed twice: as the server
+# sees them most of the time (cached) and with the cache dropped before
+# every call (uncached), which is the cost paid after every write. Lookups
+# are timed the same way with and without their compiled queries.
+#
+# usage: python -m bench.db_bench [-h] [--sizes 100x1000,400x4000] ...
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timedelta
+from bench import generate
+
+# {'count': n, 'total_ms': ..., 'mean_ms': ..., ...} for a list of seconds
+def _stats(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    ms = [ s * 1000 for s in samples ]
+    return { 'count': n, 'total_ms': sum(ms), 'mean_ms': sum(ms) / n,
+             'min_ms': ms[0], 'median_ms': ms[n // 2], 'max_ms': ms[-1] }
+
+# calls fn(*args) for each args in calls, timing every call; prepare, if
+# given, runs untimed before each call
+def _time_calls(fn, calls, prepare = None):
+    samples = []
+    for args in calls:
+        if prepare:
+            prepare()
+        start = time.time()
+        fn(*args)
+        samples.append(time.time() - start)
+    return _stats(samples)
+
+def _drop_snapshots(database):
+    database._snapshots = {}
+
+def _drop_compiled_lookups(database):
+    database._lookup_projections = {}
+    database._lookup_queries = {}
+
+def _new_matches(database, count, pending):
+    ladders = generate._current_ladders(database)
+    today = datetime.now()
+    return [ generate._match(c, o, today, pending) for c, o in [ generate._pair(ladders) for i in range(count) ] ]
+
+def run_size(path, seasons, players, matches, repeat, seed):
+    started = time.time()
+    database, summary = generate.generate(path, seasons, players, matches, seed)
+    generate_s = time.time() - started
+    player_ids = summary.pop('player_ids')
+    random.seed(seed)
+    season_id, start_date, _, _, _, _ = database.get_season()
+    timings = {}
+    ladders = [ ('a',), ('b',), ('c',), ('unranked',) ]
+    timings['get_ladder'] = _time_calls(database.get_ladder, ladders * repeat)
+    timings['get_ladder_uncached'] = _time_calls(database.get_ladder, ladders * repeat, lambda: _drop_snapshots(database))
+    timings['get_roster'] = _time_calls(database.get_roster, [ () ] * repeat)
+    timings['get_roster_uncached'] = _time_calls(database.get_roster, [ () ] * repeat, lambda: _drop_snapshots(database))
+    since = (datetime.now() - timedelta(14)).strftime('%Y-%m-%d')
+    timings['get_recent_matches_uncached'] = _time_calls(database.get_recent_matches, [ (l, since) for l in ('a', 'b', 'c') ] * repeat, lambda: _drop_snapshots(database))
+    by_player = [ ({ 'season_id': season_id, 'challenger_id': random.choice(player_ids) },) for i in range(repeat * 4) ]
+    timings['lookup_match_player'] = _time_calls(database.lookup_match, by_player)
+    timings['lookup_match_player_uncompiled'] = _time_calls(database.lookup_match, by_player, lambda: _drop_compiled_lookups(database))
+    # cheap queries, so that the cost of building them shows
+    by_id = [ ({ 'player_id': random.choice(player_ids) }, 'and') for i in range(repeat * 20) ]
+    timings['lookup_player_id'] = _time_calls(database.lookup_player, by_id)
+    timings['lookup_player_id_uncompiled'] = _time_calls(database.lookup_player, by_id, lambda: _drop_compiled_lookups(database))
+    timings['lookup_match_season'] = _time_calls(database.lookup_match, [ ({ 'season_id': season_id },) ] * repeat)
+    timings['lookup_match_all'] = _time_calls(database.lookup_match, [ ({},) ] * repeat)
+    sd = datetime.strptime(start_date, '%Y-%m-%d')
+    dates = [ (random.choice(player_ids), sd + timedelta(random.randint(0, max((datetime.now() - sd).days, 0)))) for i in range(repeat * 20) ]
+    timings['player_ladder_for_date'] = _time_calls(database.player_ladder_for_date, dates)
+    # writes; these change the league, so they go last
+    added = []
+    def add_match(m):
+        r = database.add_match(m)
+        if r[0] > 0:
+            added.append(r[0])
+    timings['add_match'] = _time_calls(add_match, [ (m,) for m in _new_matches(database, repeat * 4, False) ])
+    timings['add_match']['added'] = len(added)
+    pending = [ r[0] for r in database.add_matches(_new_matches(database, repeat * 4, True)) if r[0] > 0 ]
+    pending_matches = [ (database.lookup_match({ 'match_id': match_id })[0],) for match_id in pending ]
+    if pending_matches:
+        timings['approve_match'] = _time_calls(database.approve_match, pending_matches)
+    new_season = []
+    kick_season = []
+    for i in range(repeat):
+        prev_season, _, _, _, _, _ = database.get_season()
+        start = time.time()
+        _, err = database.new_season(datetime.now().strftime('%Y-%m-%d'), (datetime.now() + timedelta(90)).strftime('%Y-%m-%d'), 'Bench rerun {}'.format(i))
+        new_season.append(time.time() - start)
+        assert err == None, err
+        generate._reactivate(database, player_ids)
+        start = time.time()
+        database.kick_season(prev_season, ['a', 'b', 'c'], 'set')
+        kick_season.append(time.time() - start)
+    timings['new_season'] = _stats(new_season)
+    timings['kick_season'] = _stats(kick_season)
+    return { 'seasons': seasons, 'players': players, 'matches': matches,
+             'generated': summary, 'generate_s': generate_s, 'timings': timings }
+
+def main():
+    parser = argparse.ArgumentParser(description = "time Database methods on synthetic leagues")
+    parser.add_argument("--sizes", default = "50x500,200x2000,800x8000", help = "comma separated list of <players>x<matches> (default: %(default)s)")
+    parser.add_argument("--seasons", type = int, default = 3, help = "seasons in each league (default: %(default)s)")
+    parser.add_argument("--repeat", type = int, default = 10, help = "calls of each method per size, some methods are called a few times more (default: %(default)s)")
+    parser.add_argument("--seed", type = int, default = 1, help = "random seed (default: %(default)s)")
+    parser.add_argument("--output", help = "file to write the JSON results to (default: standard output)")
+    parser.add_argument("--keep", help = "directory to keep the generated databases in (default: a temporary directory that is removed)")
+    args = parser.parse_args()
+    sizes = [ tuple([ int(n) for n in s.split('x') ]) for s in args.sizes.split(',') ]
+    workdir = args.keep or tempfile.mkdtemp(prefix = 'jim-bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = []
+    try:
+        for players, matches in sizes:
+            path = os.path.join(workdir, 'bench-{}x{}.db'.format(players, matches))
+            sys.stderr.write("{} players, {} matches...\n".format(players, matches))
+            results.append(run_size(path, args.seasons, players, matches, args.repeat, args.seed))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+    report = { 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+               'platform': platform.platform(), 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+    else:
+        print(json.dumps(report, indent = 2, sort_keys = True))
+
+if __name__ == '__main__':
+    main()
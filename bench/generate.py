@@ -0,0 +1,168 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+# Builds a synthetic league for the benchmarks: a number of seasons (all but
+# the last one in the past, each archived when the next one starts) with
+# players spread over the ladders and matches between them. Matches go in
+# through the regular Database methods, so promotions, points and the match
+# limits work the same way as on the real server. Some matches are left
+# pending and some of those are disputed.
+#
+# usage: python -m bench.generate <database> [seasons] [players] [matches]
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+from jim import db
+from jim import rules
+
+# share of players that starts the first season in each ladder
+_ladder_shares = [ ('a', 0.2), ('b', 0.3), ('c', 0.35), ('unranked', 0.15) ]
+# ladders from the highest to the lowest
+_ladders = [ 'a', 'b', 'c', 'unranked' ]
+# (challenger games, opponent games) of typical matches
+_scores = [ ([6, 6], [2, 3]), ([6, 3, 6], [3, 6, 1]), ([4, 6, 6], [6, 3, 4]),
+            ([2, 3], [6, 6]), ([6, 4, 2], [3, 6, 6]), ([7, 6], [5, 4]) ]
+# season length in days
+_season_days = 120
+# share of matches reported by players and not approved yet
+_pending_share = 0.1
+# share of the pending matches that get disputed
+_disputed_share = 0.3
+# share of matches where the challenger takes on the ladder above
+_challenge_up_share = 0.03
+# matches added in one add_matches() call
+_batch = 200
+
+def _player(i, ladder):
+    return { 'username': 'bench{}'.format(i), 'password': None,
+             'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i),
+             'email': 'bench{}@example.com'.format(i), 'home_phone': '555-555-5555',
+             'cell_phone': None, 'work_phone': None, 'company': 'Bench',
+             'ladder': ladder, 'initial_points': 0, 'active': True,
+             'tournament_qualified_override': 0 }
+
+def _match(challenger_id, opponent_id, date, pending):
+    cgames, ogames = random.choice(_scores)
+    winner_id, cpoints, opoints, err = rules.process_match(challenger_id, opponent_id, cgames, ogames, False, False, date)
+    assert err == None, err
+    return { 'challenger_id': challenger_id, 'opponent_id': opponent_id, 'winner_id': winner_id,
+             'cgames': ','.join([ str(g) for g in cgames ]), 'ogames': ','.join([ str(g) for g in ogames ]),
+             'cpoints': cpoints, 'opoints': opoints, 'retired': False, 'forfeited': False,
+             'tournament': False, 'date': date.strftime('%Y-%m-%d'), 'pending': pending,
+             'disputed': False }
+
+# a pair of active players that can play each other: mostly from the same
+# ladder, sometimes a challenger from the ladder below (that's how players
+# get promoted); players in the unranked ladder only challenge the C-ladder
+def _pair(ladders):
+    everyone = [ (l, p) for l in _ladders for p in ladders.get(l, []) ]
+    while True:
+        challenger_ladder, challenger_id = random.choice(everyone)
+        above = _ladders.index(challenger_ladder) - 1
+        if challenger_ladder == 'unranked' or (above >= 0 and random.random() < _challenge_up_share):
+            opponent_ladder = _ladders[above]
+        else:
+            opponent_ladder = challenger_ladder
+        candidates = [ p for p in ladders.get(opponent_ladder, []) if p != challenger_id ]
+        if candidates:
+            return challenger_id, random.choice(candidates)
+
+def _current_ladders(database):
+    ladders = {}
+    for l in _ladders:
+        ladders[l] = [ p.get('id') for p in database.get_ladder(l) ]
+    return ladders
+
+def _reactivate(database, player_ids):
+    for player_id in player_ids:
+        player = database.lookup_player({ 'player_id': player_id }, 'and')[0]
+        player.update({ 'active': True, 'password': None })
+        database.update_player(player, player_id)
+
+# adds the season's matches in batches, in date order, and re-reads the
+# ladders between batches so that promoted players challenge from their
+# new ladder; returns (added, rejected, pending match IDs)
+def _play_season(database, start, end, matches):
+    added = 0
+    rejected = 0
+    pending_ids = []
+    days = max((end - start).days, 1)
+    dates = sorted([ start + timedelta(random.randint(0, days)) for i in range(matches) ])
+    for b in range(0, matches, _batch):
+        ladders = _current_ladders(database)
+        batch = []
+        for date in dates[b:b + _batch]:
+            challenger_id, opponent_id = _pair(ladders)
+            batch.append(_match(challenger_id, opponent_id, date, random.random() < _pending_share))
+        for m, (match_id, _, _, err) in zip(batch, database.add_matches(batch)):
+            if match_id > 0:
+                added = added + 1
+                if m.get('pending'):
+                    pending_ids.append(match_id)
+            else:
+                rejected = rejected + 1
+    return added, rejected, pending_ids
+
+# builds the league in a new database file at path; returns the Database
+# and a summary of what was generated
+def generate(path, seasons = 2, players = 100, matches = 1000, seed = 1):
+    random.seed(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rules.init()
+    database = db.Database(path)
+    today = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    # the last season is in progress, the ones before it are back to back
+    first_start = today - timedelta(_season_days // 2 + (seasons - 1) * _season_days)
+    summary = { 'seasons': seasons, 'players': players, 'matches': 0, 'rejected': 0,
+                'pending': 0, 'disputed': 0 }
+    player_ids = []
+    for s in range(seasons):
+        start = first_start + timedelta(s * _season_days)
+        end = start + timedelta(_season_days - 1)
+        prev_season, _, _, _, _, _ = database.get_season()
+        season_id, err = database.new_season(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), 'Bench season {}'.format(s + 1))
+        assert err == None, err
+        if s == 0:
+            shares = []
+            for ladder, share in _ladder_shares:
+                shares += [ ladder ] * int(round(share * 100))
+            for i in range(players):
+                player_id, err = database.update_player(_player(i, random.choice(shares)))
+                assert err == None, err
+                player_ids.append(player_id)
+        else:
+            _reactivate(database, player_ids)
+        database.kick_season(prev_season, ['a', 'b', 'c'], 'set')
+        # matches are spread evenly over the seasons, only the part of the
+        # current season that has already happened gets its share
+        added, rejected, pending_ids = _play_season(database, start, min(end, today), matches // seasons)
+        disputed = random.sample(pending_ids, int(len(pending_ids) * _disputed_share))
+        database.validate_matches(disputed, 'dispute')
+        summary['matches'] += added
+        summary['rejected'] += rejected
+        summary['pending'] += len(pending_ids) - len(disputed)
+        summary['disputed'] += len(disputed)
+    # standings built up match by match have to agree with a replay of
+    # the same matches, or the benchmarks would run against a broken league
+    differences = database.rebuild_standings(True)
+    assert not differences, differences[:10]
+    summary['player_ids'] = player_ids
+    return database, summary
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: {} <database> [seasons] [players] [matches]".format(sys.argv[0]))
+        exit(1)
+    args = [ int(a) for a in sys.argv[2:5] ]
+    _, summary = generate(sys.argv[1], *args)
+    del summary['player_ids']
+    print(summary)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+# Load test for the whole server: builds a league with bench.generate,
+# serves it from a child process with the same application that
+# run_server() uses (web.make_app), logs a number of members in (admins
+# and players) and has them click through a mix of pages for a while.
+# Reports throughput and latency percentiles for each kind of request as
+# JSON. The members are simulated by one process, so run the tool on a
+# machine with at least two cores or the client will eat into the
+# server's CPU.
+#
+# usage: python -m bench.http_load [-h] [--concurrency 20] [--duration 30] ...
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import urllib
+import argparse
+import platform
+import tempfile
+import traceback
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+from tornado import gen, httpclient
+from datetime import datetime
+from jim import db
+from jim import web
+from bench import generate
+
+# request kinds and how often each one comes up by default
+_default_mix = 'ladder=30,roster=15,profile=20,get_player=20,add_match=8,validate_match=7'
+# request kinds that only admins can make
+_admin_only = frozenset([ 'add_match', 'validate_match' ])
+_admin = ('benchadmin', 'benchpassword')
+_player_password = 'benchpassword'
+
+def _percentile(samples, p):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def _stats(latencies, errors, failures, duration):
+    latencies = sorted(latencies)
+    ms = [ l * 1000 for l in latencies ]
+    return { 'count': len(ms), 'errors': errors, 'failures': failures,
+             'throughput': len(ms) / duration,
+             'mean_ms': sum(ms) / len(ms) if ms else None,
+             'p50_ms': _percentile(ms, 50), 'p95_ms': _percentile(ms, 95),
+             'p99_ms': _percentile(ms, 99), 'max_ms': ms[-1] if ms else None }
+
+# league to test against: the database plus what the clients need to know
+# about it (who can log in, who can play whom, which matches are pending)
+def _prepare(path, seasons, players, matches, members, seed):
+    database, summary = generate.generate(path, seasons, players, matches, seed)
+    database.update_account({ 'username': _admin[0], 'password': _admin[1] })
+    player_ids = summary.pop('player_ids')
+    logins = []
+    for player_id in player_ids[:members]:
+        player = database.lookup_player({ 'player_id': player_id }, 'and')[0]
+        player.update({ 'password': _player_password })
+        database.update_player(player, player_id)
+        logins.append(player.get('username'))
+    season_id, _, _, _, _, _ = database.get_season()
+    pending = [ m.get('match_id') for m in database.lookup_match({ 'season_id': season_id, 'pending': True, 'disputed': False }) ]
+    ladders = generate._current_ladders(database)
+    last_names = [ p.get('last_name') for p in database.get_roster() ]
+    return { 'summary': summary, 'player_ids': player_ids, 'logins': logins,
+             'pending': pending, 'ladders': ladders, 'last_names': last_names }
+
+# runs the server in a child process on sock until it gets SIGTERM
+def _serve(sock, path, html_root, template_root, news, db_threads):
+    try:
+        database = db.Database(path)
+        app = web.make_app(html_root = html_root, template_root = template_root, database = database, news = news, db_threads = db_threads)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([ sock ])
+        signal.signal(signal.SIGTERM, lambda signum, frame: tornado.ioloop.IOLoop.current().add_callback_from_signal(tornado.ioloop.IOLoop.current().stop))
+        tornado.ioloop.IOLoop.current().start()
+    except:
+        traceback.print_exc()
+    finally:
+        os._exit(0)
+
+class LoadTest:
+
+    def _url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self._port, path)
+
+    @gen.coroutine
+    def _login(self, username, password):
+        body = urllib.urlencode({ 'name': username, 'password': password })
+        response = yield self._client.fetch(self._url('/login'), method = 'POST', body = body, follow_redirects = False, raise_error = False)
+        if response.headers.get('Location') != '/main_menu':
+            raise Exception("cannot log in as {}".format(username))
+        cookies = [ c.split(';')[0] for c in response.headers.get_list('Set-Cookie') ]
+        raise gen.Return('; '.join(cookies))
+
+    def _request(self, kind):
+        league = self._league
+        if kind == 'ladder':
+            return '/ladder'
+        elif kind == 'roster':
+            return '/roster'
+        elif kind == 'profile':
+            return '/profile?player_id={}'.format(random.choice(league['player_ids']))
+        elif kind == 'get_player':
+            return '/get_player?' + urllib.urlencode({ 'active': 'yes', 'last_name': random.choice(league['last_names']) })
+        elif kind == 'add_match':
+            challenger_id, opponent_id = generate._pair(league['ladders'])
+            m = generate._match(challenger_id, opponent_id, datetime.now(), False)
+            args = [ ('challenger', challenger_id), ('opponent', opponent_id), ('date', m['date']) ]
+            args += [ ('cgames', g) for g in m['cgames'].split(',') ] + [ ('ogames', g) for g in m['ogames'].split(',') ]
+            return '/add_match?' + urllib.urlencode(args)
+        elif kind == 'validate_match':
+            if not league['pending']:
+                return None
+            return '/validate_match?action=approve&match_id={}'.format(league['pending'].pop())
+
+    # one member: picks the next request from the mix, sends it and waits
+    # for the answer, until the time is up
+    @gen.coroutine
+    def _member(self, cookie, admin_cookie):
+        while time.time() < self._deadline:
+            kind = random.choice(self._kinds)
+            path = self._request(kind)
+            if path == None:
+                # nothing left to do of this kind
+                self._kinds = [ k for k in self._kinds if k != kind ]
+                if not self._kinds:
+                    break
+                continue
+            headers = { 'Cookie': admin_cookie if kind in _admin_only else cookie }
+            start = time.time()
+            response = yield self._client.fetch(self._url(path), headers = headers, follow_redirects = False, raise_error = False)
+            self._latencies[kind].append(time.time() - start)
+            if response.code >= 400 or response.code < 200:
+                self._errors[kind] += 1
+            elif response.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    if json.loads(response.body).get('result') == 'failure':
+                        self._failures[kind] += 1
+                except (ValueError, AttributeError):
+                    pass
+
+    @gen.coroutine
+    def run(self):
+        admin_cookie = yield self._login(*_admin)
+        cookies = []
+        for i in range(self._concurrency):
+            if i < self._admins:
+                cookies.append(admin_cookie)
+            else:
+                username = self._league['logins'][i % len(self._league['logins'])]
+                cookie = yield self._login(username, _player_password)
+                cookies.append(cookie)
+        started = time.time()
+        self._deadline = started + self._duration
+        yield [ self._member(cookie, admin_cookie) for cookie in cookies ]
+        raise gen.Return(time.time() - started)
+
+    def report(self, duration):
+        endpoints = {}
+        for kind in self._latencies:
+            endpoints[kind] = _stats(self._latencies[kind], self._errors[kind], self._failures[kind], duration)
+        everything = sum(self._latencies.values(), [])
+        total = _stats(everything, sum(self._errors.values()), sum(self._failures.values()), duration)
+        return { 'duration_s': duration, 'total': total, 'endpoints': endpoints }
+
+    def __init__(self, port, league, mix, concurrency, admins, duration):
+        self._port = port
+        self._league = league
+        self._concurrency = concurrency
+        self._admins = admins
+        self._duration = duration
+        self._kinds = []
+        for kind, weight in mix:
+            self._kinds += [ kind ] * weight
+        self._latencies = dict([ (kind, []) for kind, _ in mix ])
+        self._errors = dict([ (kind, 0) for kind, _ in mix ])
+        self._failures = dict([ (kind, 0) for kind, _ in mix ])
+        self._client = httpclient.AsyncHTTPClient(max_clients = concurrency + 1)
+
+def _parse_mix(mix):
+    parsed = []
+    for entry in mix.split(','):
+        kind, weight = entry.split('=')
+        parsed.append((kind.strip(), int(weight)))
+    return parsed
+
+def main():
+    here = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    parser = argparse.ArgumentParser(description = "drive the jim web application with simulated members")
+    parser.add_argument("--players", type = int, default = 200, help = "players in the generated league (default: %(default)s)")
+    parser.add_argument("--matches", type = int, default = 2000, help = "matches in the generated league (default: %(default)s)")
+    parser.add_argument("--seasons", type = int, default = 2, help = "seasons in the generated league (default: %(default)s)")
+    parser.add_argument("--concurrency", type = int, default = 20, help = "members making requests at the same time (default: %(default)s)")
+    parser.add_argument("--admins", type = int, default = 2, help = "how many of the members are admins (default: %(default)s)")
+    parser.add_argument("--duration", type = float, default = 30, help = "seconds to run for (default: %(default)s)")
+    parser.add_argument("--mix", default = _default_mix, help = "request kinds and their weights (default: %(default)s)")
+    parser.add_argument("--db-threads", type = int, default = 4, help = "database reader threads of the server (default: %(default)s)")
+    parser.add_argument("--html-root", default = os.path.join(here, 'html'), help = "static files (default: %(default)s)")
+    parser.add_argument("--template-root", default = os.path.join(here, 'templates'), help = "templates (default: %(default)s)")
+    parser.add_argument("--seed", type = int, default = 1, help = "random seed (default: %(default)s)")
+    parser.add_argument("--output", help = "file to write the JSON results to (default: standard output)")
+    args = parser.parse_args()
+    mix = _parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix = 'jim-load-')
+    pid = None
+    try:
+        path = os.path.join(workdir, 'load.db')
+        sys.stderr.write("generating {} players, {} matches...\n".format(args.players, args.matches))
+        league = _prepare(path, args.seasons, args.players, args.matches, max(args.concurrency - args.admins, 1), args.seed)
+        sock = tornado.netutil.bind_sockets(0, '127.0.0.1')[0]
+        port = sock.getsockname()[1]
+        pid = os.fork()
+        if pid == 0:
+            _serve(sock, path, args.html_root, args.template_root, os.path.join(workdir, 'news.txt'), args.db_threads)
+        sock.close()
+        sys.stderr.write("running {} members against port {} for {} seconds...\n".format(args.concurrency, port, args.duration))
+        random.seed(args.seed)
+        test = LoadTest(port, league, mix, args.concurrency, args.admins, args.duration)
+        duration = tornado.ioloop.IOLoop.current().run_sync(test.run, timeout = args.duration * 2 + 60)
+        report = test.report(duration)
+    finally:
+        if pid:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        shutil.rmtree(workdir)
+    report.update({ 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                    'league': league['summary'], 'concurrency': args.concurrency,
+                    'admins': args.admins, 'mix': dict(mix) })
+    for kind, s in sorted(report['endpoints'].items()):
+        if s['count']:
+            sys.stderr.write("{:16} {:7d} req {:8.1f} req/s  p50 {:7.1f}  p95 {:7.1f}  p99 {:7.1f} ms  errors {}  failures {}\n".format(kind, s['count'], s['throughput'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['errors'], s['failures']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+    else:
+        print(json.dumps(report, indent = 2, sort_keys = True))
+
+if __name__ == '__main__':
+    main()
@@ -58,6 +58,37 @@ def read_config(parser):
         cfg['autoreload'] = parser.get("web", "autoreload")
     except:
         cfg['autoreload'] = False
+    try:
+        cfg['db_threads'] = int(parser.get("db", "db_threads"))
+    except:
+        cfg['db_threads'] = 4
+    try:
+        cfg['password_threads'] = int(parser.get("db", "password_threads"))
+    except:
+        cfg['password_threads'] = 2
+    try:
+        cfg['compress_level'] = int(parser.get("web", "compress_level"))
+    except:
+        cfg['compress_level'] = 6
+    try:
+        cfg['compress_min_length'] = int(parser.get("web", "compress_min_length"))
+    except:
+        cfg['compress_min_length'] = 1024
+    try:
+        cfg['query_stats'] = parser.get("db", "query_stats").lower() == 'true'
+    except:
+        cfg['query_stats'] = False
+    try:
+        cfg['query_repeat_limit'] = int(parser.get("db", "query_repeat_limit"))
+    except:
+        cfg['query_repeat_limit'] = 10
+    try:
+        cfg['log_level'] = parser.get("log", "level").upper()
+        if not isinstance(logging.getLevelName(cfg['log_level']), int):
+            _log.error("unknown log level %s", cfg['log_level'])
+            cfg['log_level'] = 'INFO'
+    except:
+        cfg['log_level'] = 'INFO'
     try:
         p = parser.get("web", "player_reports_matches")
         if p.lower() == 'true':
@@ -86,10 +117,11 @@ def do_main():
         _log.error("no configuration file found")
         config_ok = False
     else:
-        _log.info("using configuration files {}".format(config_file_list))
+        _log.info("using configuration files %s", config_file_list)
     if config_ok:
         cfg = read_config(config_file_parser)
-        _log.info("server configuration: {}".format(cfg))
+        logging.getLogger().setLevel(cfg['log_level'])
+        _log.info("server configuration: %s", cfg)
         _log.info("starting server")
         db_file = cfg.get('db_file')
         if db_file:
@@ -103,7 +135,7 @@ def do_main():
                             'keyfile': certs_path + '/key.pem' }
         else:
             ssl_options = util.test_ssl_options
-        web.run_server(ssl_options = ssl_options, http_port = cfg.get('http_port'), https_port = cfg.get('https_port'), bounce_port = cfg.get('bounce_port'), html_root = cfg.get('html_root'), template_root = cfg.get('template_root'), database = database, news = news, bootstrap_token = cfg.get('bootstrap_token'), player_reports_matches = cfg.get('player_reports_matches'), autoreload = cfg.get('autoreload'))
+        web.run_server(ssl_options = ssl_options, http_port = cfg.get('http_port'), https_port = cfg.get('https_port'), bounce_port = cfg.get('bounce_port'), html_root = cfg.get('html_root'), template_root = cfg.get('template_root'), database = database, news = news, bootstrap_token = cfg.get('bootstrap_token'), player_reports_matches = cfg.get('player_reports_matches'), autoreload = cfg.get('autoreload'), db_threads = cfg.get('db_threads'), password_threads = cfg.get('password_threads'), compress_level = cfg.get('compress_level'), compress_min_length = cfg.get('compress_min_length'), query_stats = cfg.get('query_stats'), query_repeat_limit = cfg.get('query_repeat_limit'))
         _log.info("server exited")
     else:
         _log.error("configuration error")
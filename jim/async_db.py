@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+import db
+import util
+import time
+from concurrent import futures
+from tornado import gen
+
+# Database methods that only read; these run on the reader pool, each
+# thread with its own read-only connection, so they run side by side
+# with each other and with the writer
+_read_methods = frozenset([
+    'get_season',
+    'get_tournament_parameters',
+    'get_match_and_opponent_count',
+    'get_match_and_opponent_counts',
+    'get_db_version',
+    'get_recent_matches',
+    'get_archived_ladder',
+    'get_ladder',
+    'get_roster',
+    'ladder_changed',
+    'no_admins',
+    'get_password_hash',
+    'player_ladder_for_date',
+    'player_ladders_for_dates',
+    'lookup_player',
+    'lookup_match',
+    'lookup_account',
+    'export_matches',
+    'export_player_archive'
+])
+
+# Database methods that modify the database; these run one at a
+# time on the writer thread, in the order they were submitted
+_write_methods = frozenset([
+    'new_season',
+    'set_tournament_parameters',
+    'set_init_points',
+    'kick_season',
+    'kick_if_needed',
+    'update_player',
+    'delete_player',
+    'update_account',
+    'delete_account',
+    'approve_match',
+    'dispute_match',
+    'validate_matches',
+    'add_match',
+    'add_matches',
+    'rebuild_standings'
+])
+
+# wraps db.Database so that its methods run off the IOLoop thread:
+# every method listed above is available under the same name, but it
+# returns a Future that the handler coroutines can yield
+class AsyncDatabase:
+
+    def _timed(self, context, name, method, *args, **kwargs):
+        if self._on_statements:
+            # whatever an earlier call left on this thread is not ours
+            self._database.take_statement_counts()
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            if self._on_call:
+                self._on_call(name, time.time() - start)
+            if self._on_statements:
+                self._on_statements(context, name, self._database.take_statement_counts())
+
+    def _submit(self, executor, name, method, *args, **kwargs):
+        if self._on_call or self._on_statements:
+            context = self._context() if self._context else None
+            return executor.submit(self._timed, context, name, method, *args, **kwargs)
+        return executor.submit(method, *args, **kwargs)
+
+    def _submitter(self, executor, name):
+        def submit(*args, **kwargs):
+            return self._submit(executor, name, getattr(self._database, name), *args, **kwargs)
+        return submit
+
+    @gen.coroutine
+    def check_password(self, username, password, table):
+        # only the hash lookup needs the database, the bcrypt check runs on
+        # its own small pool so a burst of logins cannot starve page views
+        account_id, password_hash = yield self.get_password_hash(username, table)
+        if account_id == None:
+            raise gen.Return(None)
+        matches = yield self._password_checkers.submit(db.password_matches, password, password_hash)
+        if matches:
+            raise gen.Return(account_id)
+        else:
+            self._log.debug("check_password: %s in %s password check failed", username, table)
+            raise gen.Return(None)
+
+    # only reads a counter, no need to go through the pool
+    def get_data_version(self):
+        return self._database.get_data_version()
+
+    # chunks of an export opened with one of the export_ methods
+    def fetch_export(self, export, count):
+        return self._submit(self._readers, 'fetch_export', export.fetch, count)
+
+    def close_export(self, export):
+        return self._submit(self._readers, 'close_export', export.close)
+
+    def __getattr__(self, name):
+        if name in _read_methods:
+            return self._submitter(self._readers, name)
+        elif name in _write_methods:
+            return self._submitter(self._writer, name)
+        else:
+            raise AttributeError(name)
+
+    # on_call, if given, is called with the method name and the seconds it
+    # took after every database call (on the thread that made the call);
+    # on_statements, if given, turns on statement counting in the database
+    # and is called after every database call with what context() returned
+    # when the call was submitted, the method name and the statement counts
+    def __init__(self, database, max_readers = 4, max_password_checks = 2, on_call = None, on_statements = None, context = None):
+        self._log = util.get_syslog_logger("async_db")
+        self._log.info("starting database executor with %s reader threads", max_readers)
+        self._log.info("allowing %s concurrent password checks", max_password_checks)
+        self._database = database
+        self._on_call = on_call
+        self._on_statements = on_statements
+        self._context = context
+        if on_statements:
+            self._log.info("counting database statements")
+            database.count_statements()
+        self._readers = futures.ThreadPoolExecutor(max_readers)
+        self._writer = futures.ThreadPoolExecutor(1)
+        self._password_checkers = futures.ThreadPoolExecutor(max_password_checks)
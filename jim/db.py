@@ -6,11 +6,16 @@
 
 import util
 import rules
+import logging
 import sqlite3
 import string
 import os
+import re
+import time
 import bcrypt
 import random
+import threading
+import bisect
 from datetime import datetime
 
 # each time the schema is changed, add a new entry here
@@ -90,11 +95,151 @@ _schema = [
     [ 'ALTER TABLE seasons ADD COLUMN prev_id INTEGER;',
       'INSERT INTO revisions (date, comment) VALUES (date("now"), "add previous season id to the seasons table");'],
     ['ALTER TABLE seasons ADD COLUMN kicked NOT NULL DEFAULT TRUE;',
-     'INSERT INTO revisions (date, comment) VALUES (date("now"), "add kicked flag to the seasons table");']
+     'INSERT INTO revisions (date, comment) VALUES (date("now"), "add kicked flag to the seasons table");'],
+    [ 'CREATE INDEX matches_season_challenger ON matches (season_id, challenger_id);',
+      'CREATE INDEX matches_season_opponent ON matches (season_id, opponent_id);',
+      'CREATE INDEX matches_season_ladder_date ON matches (season_id, ladder, date);',
+      'CREATE INDEX matches_season_pending ON matches (season_id, pending, disputed);',
+      'INSERT INTO revisions (date, comment) VALUES (date("now"), "add indexes for match lookups");'],
+    [ 'CREATE TABLE ladder_intervals (player_id INTEGER NOT NULL, ladder TEXT NOT NULL, valid_from DATE, valid_to DATE);',
+      'CREATE INDEX ladder_intervals_player ON ladder_intervals (player_id, valid_from);',
+      'INSERT INTO revisions (date, comment) VALUES (date("now"), "added ladder_intervals");'],
+    [ 'ALTER TABLE matches ADD COLUMN credited INTEGER;',
+      'UPDATE matches SET credited=id WHERE NOT pending AND NOT disputed;',
+      'CREATE INDEX matches_credited ON matches (credited);',
+      'INSERT INTO revisions (date, comment) VALUES (date("now"), "record the order in which matches are credited");']
 ]
 
+# methods that modify the database run one at a time on the writer
+# connection; any read they make while holding it goes through the same
+# connection, so they see their own uncommitted changes
+def _writes(method):
+    def locked_method(self, *args, **kwargs):
+        with self._write_lock:
+            self._local.writing = getattr(self._local, 'writing', 0) + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._local.writing = self._local.writing - 1
+    locked_method.__name__ = method.__name__
+    return locked_method
+
+# deliberately slow (that's what bcrypt is for), so keep it
+# off the IOLoop thread when called from the web server
+def password_matches(password, password_hash):
+    return bcrypt.hashpw(str(password), str(password_hash)) == str(password_hash)
+
+# query results that are read a chunk at a time instead of all at once;
+# the query runs on a connection of its own, which stays open until the
+# last chunk is read or the export is closed, so the whole export is one
+# consistent snapshot; chunks may be read from different threads, but
+# never from two threads at the same time
+class ExportCursor:
+
+    def fetch(self, count):
+        if self._conn == None:
+            return []
+        records = self._cursor.fetchmany(count)
+        if len(records) < count:
+            self.close()
+        return records
+
+    def close(self):
+        if self._conn != None:
+            self._conn.close()
+            self._conn = None
+
+    def __init__(self, db_file, fields, query, values):
+        self.fields = fields
+        self._conn = sqlite3.connect(db_file, check_same_thread = False)
+        self._conn.execute('PRAGMA query_only = ON;')
+        self._cursor = self._conn.cursor()
+        self._cursor.execute(query, values)
+
+# the lookup query cache is emptied when it grows past this many entries
+_max_lookup_queries = 256
+
+# a run of placeholders, as in "id IN (?, ?, ?)"
+_placeholder_list = re.compile(r'\?(\s*,\s*\?)+')
+
+# statement text with the whitespace squeezed and placeholder lists folded,
+# so that the same query with other values or another number of IDs is
+# counted as one
+def _fingerprint(sql):
+    return _placeholder_list.sub('?, ...', ' '.join(sql.split()))
+
+# stands in for a cursor once statement counting is on, see
+# Database.count_statements(); everything else goes to the real cursor
+class _CountingCursor:
+
+    def execute(self, sql, *args):
+        start = time.time()
+        try:
+            self._cursor.execute(sql, *args)
+        finally:
+            self._database._count_statement(sql, time.time() - start)
+        return self
+
+    def executemany(self, sql, *args):
+        start = time.time()
+        try:
+            self._cursor.executemany(sql, *args)
+        finally:
+            self._database._count_statement(sql, time.time() - start)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __init__(self, database, cursor):
+        self._database = database
+        self._cursor = cursor
+
 class Database:
 
+    def _read_cursor(self):
+        # writers read through their own connection, everyone else gets
+        # a read-only connection of their own (one per thread), which in
+        # WAL mode sees the last committed state without waiting for writers
+        if getattr(self._local, 'writing', 0):
+            return self._cursor
+        conn = getattr(self._local, 'conn', None)
+        if conn == None:
+            self._log.debug("opening reader connection for thread %s", threading.current_thread().name)
+            conn = sqlite3.connect(self._db_file)
+            conn.execute('PRAGMA query_only = ON;')
+            self._local.conn = conn
+        if self._counting:
+            return _CountingCursor(self, conn.cursor())
+        return conn.cursor()
+
+    # from now on, count the statements that each thread runs and the time
+    # they take (in execute, rows fetched later are not included); meant
+    # to be turned on once, before the database is in use
+    def count_statements(self):
+        if not self._counting:
+            self._counting = True
+            self._cursor = _CountingCursor(self, self._cursor)
+
+    def _count_statement(self, sql, seconds):
+        counts = getattr(self._local, 'statements', None)
+        if counts == None:
+            counts = {}
+            self._local.statements = counts
+        key = _fingerprint(sql)
+        count, total = counts.get(key, (0, 0.0))
+        counts[key] = (count + 1, total + seconds)
+
+    # statements counted on this thread since the last call, as
+    # {fingerprint: (count, seconds)}, and start counting over
+    def take_statement_counts(self):
+        counts = getattr(self._local, 'statements', None) or {}
+        self._local.statements = {}
+        return counts
+
     def _compare_ladders(self, l1, l2):
         if self._ladder_weights.get(l1) == self._ladder_weights.get(l2):
             return 0
@@ -103,129 +248,221 @@ class Database:
         if self._ladder_weights.get(l1) < self._ladder_weights.get(l2):
             return -1
 
-    def player_ladder_for_date(self, player_id, date):
-        self._cursor.execute('SELECT a_promotion, b_promotion, c_promotion, ladder FROM players WHERE id=?', (player_id,))
-        v = self._cursor.fetchall()
-        if len(v) == 0:
-            self._log.error("player {} not found".format(player_id))
-            return None
-        assert len(v) == 1
-        a_promotion, b_promotion, c_promotion, ladder = v[0]
-        a_prm, b_prm, c_prm = None, None, None
+    # dates on which the player entered each ladder, as far as the promotion
+    # columns tell: '' means since forever and None means never
+    def _ladder_start_dates(self, player_id, a_promotion, b_promotion, c_promotion, ladder):
         if ladder.lower() == 'a':
             if not a_promotion:
                 # A-player that has been in A-ladder forever
-                a_prm = datetime.min
+                a_prm = ''
                 if b_promotion or c_promotion:
-                    self._log.warning("expected None for a-ladder player {}, got: b_promotion={}, c_promotion={}".format(player_id, b_promotion, c_promotion))
+                    self._log.warning("expected None for a-ladder player %s, got: b_promotion=%s, c_promotion=%s", player_id, b_promotion, c_promotion)
                 b_promotion = None
                 c_promotion = None
             else:
                 # A-player that entered A-ladder at some point
-                a_prm = datetime.strptime(a_promotion, '%Y-%m-%d')
+                a_prm = a_promotion
             if not b_promotion:
                 # A-player that has been in B forever before being
                 # promoted to A or started directly in A
-                b_prm = datetime.min
+                b_prm = ''
                 if c_promotion:
-                    self._log.warning("expected None for a-ladder player {}, got: c_promotion={}".format(player_id, c_promotion))
+                    self._log.warning("expected None for a-ladder player %s, got: c_promotion=%s", player_id, c_promotion)
                 c_promotion = None
             else:
                 # A-player that entered B at some point
-                b_prm = datetime.strptime(b_promotion, '%Y-%m-%d')
-            if not c_promotion:
-                # A player that has been in C forever before being promoted
-                # to A or B or started directly in either B or C
-                c_prm = datetime.min
-            else:
-                c_prm = datetime.strptime(c_promotion, '%Y-%m-%d')
+                b_prm = b_promotion
+            # A player that has been in C forever before being promoted
+            # to A or B or started directly in either B or C
+            c_prm = c_promotion or ''
         elif ladder.lower() == 'b':
             # B-player, can't have A-promotion date, period
             if a_promotion:
-                self._log.warning("expected None for b-ladder player {}, got: a_promotion={}".format(player_id, a_promotion))
-            a_promotion = None
-            a_prm = datetime.max
+                self._log.warning("expected None for b-ladder player %s, got: a_promotion=%s", player_id, a_promotion)
+            a_prm = None
             if not b_promotion:
                 # B-player that has been in B forever
-                b_prm = datetime.min
+                b_prm = ''
                 if c_promotion:
-                    self._log.warning("expected None for b-ladder player {}, got: c_prmotion={}".format(player_id, c_promotion))
+                    self._log.warning("expected None for b-ladder player %s, got: c_prmotion=%s", player_id, c_promotion)
                 c_promotion = None
             else:
                 # B-player that has entered B at some point
-                b_prm = datetime.strptime(b_promotion, '%Y-%m-%d')
-            if not c_promotion:
-                # B-player that has been in C forever before promoted to B or
-                # started directly in B
-                c_prm = datetime.min
-            else:
-                # B-player that has been at some point promoted to C
-                c_prm = datetime.strptime(c_promotion, '%Y-%m-%d')
+                b_prm = b_promotion
+            # B-player that has been in C forever before promoted to B,
+            # started directly in B or has been promoted to C at some point
+            c_prm = c_promotion or ''
         elif ladder.lower() == 'c':
             if a_promotion or b_promotion:
-                self._log.warning("expected None for c-ladder player {}, got: a_promotion={}, b_promotion={}".format(player_id, a_promotion, b_promotion))
-            a_promotion = None
-            b_promotion = None
-            a_prm = datetime.max
-            b_prm = datetime.max
-            if not c_promotion:
-                # C-player that has been in C forever or started in C
-                c_prm = datetime.min
-            else:
-                # C-player that has been promoted to C at some point
-                c_prm = datetime.strptime(c_promotion, '%Y-%m-%d')
+                self._log.warning("expected None for c-ladder player %s, got: a_promotion=%s, b_promotion=%s", player_id, a_promotion, b_promotion)
+            a_prm = None
+            b_prm = None
+            # C-player that has been in C forever, started in C
+            # or has been promoted to C at some point
+            c_prm = c_promotion or ''
         else:
             if ladder.lower() != "unranked":
-                self._log.warning("expected unranked player ladder, got: {}".format(ladder.lower()))
-            return "unranked"
-        assert (a_prm and b_prm and c_prm) is not None
-        self._log.info("checking player {} for {} in ranges {}-{}-{}".format(player_id, date, c_prm, b_prm, a_prm))
-        if date >= a_prm:
-            ladder = "a"
-        elif date >= b_prm and date < a_prm:
-            ladder = "b"
-        elif date >= c_prm and date < b_prm:
-            ladder = "c"
+                self._log.warning("expected unranked player ladder, got: %s", ladder.lower())
+            return None
+        return a_prm, b_prm, c_prm
+
+    # [(ladder, valid_from, valid_to)] for the player, sorted by valid_from;
+    # '' for valid_from means since forever, None for valid_to means until now,
+    # and the player is unranked on any date not covered by an interval
+    def _ladder_intervals(self, player_id, a_promotion, b_promotion, c_promotion, ladder):
+        start_dates = self._ladder_start_dates(player_id, a_promotion, b_promotion, c_promotion, ladder)
+        if start_dates == None:
+            return []
+        a_prm, b_prm, c_prm = start_dates
+        intervals = []
+        # a higher ladder wins wherever intervals would overlap
+        end = None
+        for l, start in [('a', a_prm), ('b', b_prm), ('c', c_prm)]:
+            if start != None and (end == None or start < end):
+                intervals = [(l, start, end)] + intervals
+                end = start
+        return intervals
+
+    def _ladder_index_entry(self, intervals):
+        return tuple(i[1] for i in intervals), tuple(intervals)
+
+    def _update_ladder_intervals(self, player_id):
+        # writer only: recompute the player's intervals from the promotion
+        # columns; the index entry becomes visible to readers on commit
+        self._cursor.execute('SELECT a_promotion, b_promotion, c_promotion, ladder FROM players WHERE id=?', (player_id,))
+        v = self._cursor.fetchall()
+        self._cursor.execute('DELETE FROM ladder_intervals WHERE player_id=?', (player_id,))
+        if len(v) == 0:
+            self._ladder_index_pending[player_id] = None
+            return
+        a_promotion, b_promotion, c_promotion, ladder = v[0]
+        intervals = self._ladder_intervals(player_id, a_promotion, b_promotion, c_promotion, ladder)
+        for l, valid_from, valid_to in intervals:
+            self._cursor.execute('INSERT INTO ladder_intervals (player_id, ladder, valid_from, valid_to) VALUES (?, ?, ?, ?)', (player_id, l, valid_from or None, valid_to))
+        self._ladder_index_pending[player_id] = self._ladder_index_entry(intervals)
+
+    def _rebuild_ladder_intervals(self):
+        # writer only: the intervals are derived from the promotion columns,
+        # so they can always be thrown away and recomputed
+        self._cursor.execute('DELETE FROM ladder_intervals')
+        for player_id, a_promotion, b_promotion, c_promotion, ladder in self._cursor.execute('SELECT id, a_promotion, b_promotion, c_promotion, ladder FROM players').fetchall():
+            intervals = self._ladder_intervals(player_id, a_promotion, b_promotion, c_promotion, ladder)
+            for l, valid_from, valid_to in intervals:
+                self._cursor.execute('INSERT INTO ladder_intervals (player_id, ladder, valid_from, valid_to) VALUES (?, ?, ?, ?)', (player_id, l, valid_from or None, valid_to))
+            self._ladder_index_pending[player_id] = self._ladder_index_entry(intervals)
+
+    def _load_ladder_index(self):
+        cursor = self._read_cursor()
+        intervals = { r[0]: [] for r in cursor.execute('SELECT id FROM players') }
+        for player_id, l, valid_from, valid_to in cursor.execute('SELECT player_id, ladder, valid_from, valid_to FROM ladder_intervals ORDER BY player_id, valid_from'):
+            intervals.setdefault(player_id, []).append((l, valid_from or '', valid_to))
+        self._ladder_index = { p: self._ladder_index_entry(intervals[p]) for p in intervals }
+        self._log.info("loaded ladder intervals for %s players", len(self._ladder_index))
+
+    def _publish_ladder_index(self):
+        # readers always see a complete index, either before or after the change
+        if self._ladder_index_pending:
+            index = dict(self._ladder_index)
+            index.update(self._ladder_index_pending)
+            self._ladder_index = { p: index[p] for p in index if index[p] != None }
+            self._ladder_index_pending = {}
+
+    def _ladder_index_lookup(self, index, pending, player_id, date):
+        if pending != None and player_id in pending:
+            entry = pending[player_id]
         else:
-            ladder = "unranked"
-        self._log.info("player {} was in ladder {} on {}".format(player_id, ladder, date))
+            entry = index.get(player_id)
+        if entry == None:
+            self._log.error("player %s not found", player_id)
+            return None
+        starts, intervals = entry
+        day = date.strftime('%Y-%m-%d')
+        i = bisect.bisect_right(starts, day) - 1
+        if i >= 0 and (intervals[i][2] == None or day < intervals[i][2]):
+            return intervals[i][0]
+        else:
+            return "unranked"
+
+    def player_ladders_for_dates(self, queries):
+        # writers see the changes they haven't committed yet
+        index = self._ladder_index
+        pending = self._ladder_index_pending if getattr(self._local, 'writing', 0) else None
+        ladders = [ self._ladder_index_lookup(index, pending, player_id, date) for player_id, date in queries ]
+        self._log.debug("player_ladders_for_dates: %s --> %s", queries, ladders)
+        return ladders
+
+    def player_ladder_for_date(self, player_id, date):
+        ladder = self.player_ladders_for_dates([(player_id, date)])[0]
+        self._log.info("player %s was in ladder %s on %s", player_id, ladder, date)
         return ladder
 
-    def get_season(self):
-        self._cursor.execute('SELECT id, start_date, end_date, title, prev_id, kicked FROM seasons WHERE active=1')
-        v = self._cursor.fetchall()
+    def _load_season_context(self):
+        # active season and its tournament parameters change only when
+        # the season is created, kicked or its tournament is set up, so
+        # we read them once and keep them until one of those happens
+        generation = self._season_generation
+        cursor = self._read_cursor()
+        cursor.execute('SELECT id, start_date, end_date, title, prev_id, kicked, tournament_min_matches, tournament_min_opponents, tournament_date FROM seasons WHERE active=1')
+        v = cursor.fetchall()
         assert len(v) == 1
         v = v[0]
-        return v
+        context = { 'season': v[0:6], 'tournament': v[6:9] }
+        self._log.debug("loaded season context %s", context)
+        # don't keep it if a writer invalidated the context while we were reading
+        if generation == self._season_generation:
+            self._season_context = context
+        return context
+
+    def _invalidate_season_context(self):
+        self._season_generation = self._season_generation + 1
+        self._season_context = None
+
+    def get_season(self):
+        context = self._season_context or self._load_season_context()
+        return context['season']
 
+    @_writes
     def set_tournament_parameters(self, start_date, min_matches, min_opponents):
         season_id, _, _, _, _, _ = self.get_season()
         self._cursor.execute("UPDATE seasons SET tournament_date=?, tournament_min_matches=?, tournament_min_opponents=? WHERE id=?", (start_date, min_matches, min_opponents, season_id))
         self._conn.commit()
+        self._invalidate_season_context()
+        self._bump_data_version()
 
     def get_tournament_parameters(self):
-        self._cursor.execute('SELECT tournament_min_matches, tournament_min_opponents, tournament_date FROM seasons WHERE active=1')
-        v = self._cursor.fetchall()
-        assert len(v) == 1
-        return v[0]
+        context = self._season_context or self._load_season_context()
+        return context['tournament']
 
     def get_match_and_opponent_count(self, player_id):
         season_id, _, _, _, _, _ = self.get_season()
+        cursor = self._read_cursor()
         # all-opponent set cardinal number is the number of different opponents the player had
-        self._cursor.execute('SELECT COUNT(*) FROM (SELECT opponent_id FROM matches WHERE challenger_id=? AND season_id=? AND NOT disputed AND NOT pending UNION SELECT challenger_id FROM matches WHERE opponent_id=? AND season_id=? AND NOT disputed and NOT pending)', (player_id, season_id, player_id, season_id))
-        v = self._cursor.fetchall()
+        cursor.execute('SELECT COUNT(*) FROM (SELECT opponent_id FROM matches WHERE challenger_id=? AND season_id=? AND NOT disputed AND NOT pending UNION SELECT challenger_id FROM matches WHERE opponent_id=? AND season_id=? AND NOT disputed and NOT pending)', (player_id, season_id, player_id, season_id))
+        v = cursor.fetchall()
         assert len(v) == 1
         num_opponents_tuple = v[0]
         # very similar query, but without unique union will give us all matches played
-        self._cursor.execute('SELECT COUNT(*) FROM (SELECT opponent_id FROM matches WHERE challenger_id=? and season_id=? AND NOT disputed AND NOT pending UNION ALL SELECT challenger_id FROM matches WHERE opponent_id=? AND season_id=? AND NOT disputed AND NOT pending)', (player_id, season_id, player_id, season_id))
-        v = self._cursor.fetchall()
+        cursor.execute('SELECT COUNT(*) FROM (SELECT opponent_id FROM matches WHERE challenger_id=? and season_id=? AND NOT disputed AND NOT pending UNION ALL SELECT challenger_id FROM matches WHERE opponent_id=? AND season_id=? AND NOT disputed AND NOT pending)', (player_id, season_id, player_id, season_id))
+        v = cursor.fetchall()
         assert len(v) == 1
         num_matches_tuple = v[0]
         return num_matches_tuple + num_opponents_tuple
 
+    def get_match_and_opponent_counts(self):
+        season_id, _, _, _, _, _ = self.get_season()
+        cursor = self._read_cursor()
+        # same counts as above, but for all players of the season in one pass:
+        # each match is listed once from the challenger's and once from the
+        # opponent's side, then grouped by player
+        counts = {}
+        for player_id, num_matches, num_opponents in cursor.execute('SELECT player_id, COUNT(*), COUNT(DISTINCT other_id) FROM (SELECT challenger_id AS player_id, opponent_id AS other_id FROM matches WHERE season_id=? AND NOT disputed AND NOT pending UNION ALL SELECT opponent_id, challenger_id FROM matches WHERE season_id=? AND NOT disputed AND NOT pending) GROUP BY player_id', (season_id, season_id)):
+            counts[player_id] = (num_matches, num_opponents)
+        return counts
+
+    @_writes
     def new_season(self, start_date, end_date, title, tournament_date = None):
         prev_id, _, _, _, _, _ = self.get_season()
-        self._log.debug("archiving season {} before starting new season".format(prev_id))
+        self._log.debug("archiving season %s before starting new season", prev_id)
         if not tournament_date:
             tournament_date = end_date
         self._cursor.execute("SELECT id FROM seasons WHERE title=?", (title,))
@@ -234,21 +471,27 @@ class Database:
             return None, "Season title already in use"
         self._cursor.execute("SELECT seasons.id, players.id, ladder, points, initial_points, players.active, wins, losses, a_wins, a_losses, b_wins, b_losses, c_wins, c_losses FROM players LEFT JOIN seasons WHERE seasons.active=1")
         archived_players = self._cursor.fetchall()
-        self._log.debug("archived {} players".format(len(archived_players)))
+        self._log.debug("archived %s players", len(archived_players))
+        debug = self._log.isEnabledFor(logging.DEBUG)
         for ap in archived_players:
-            self._log.debug("  {}".format(ap))
+            if debug:
+                self._log.debug("  %s", ap)
             self._cursor.execute("INSERT INTO player_archive (season_id, player_id, ladder, points, initial_points, active, wins, losses, a_wins, a_losses, b_wins, b_losses, c_wins, c_losses) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ap)
         season_value_tuple = (prev_id, start_date, end_date, tournament_date, title, 1, 0)
         self._cursor.execute("UPDATE seasons set active=0")
         self._cursor.execute("UPDATE players set active=0, points=0, initial_points=0, wins=0, losses=0, a_wins=0, a_losses=0, b_wins=0, b_losses=0, c_wins=0, c_losses=0,  tournament_qualified_override=0, a_promotion=NULL, b_promotion=NULL, c_promotion=NULL")
-        self._log.debug("new season value tuple: {}".format(season_value_tuple))
+        self._rebuild_ladder_intervals()
+        self._log.debug("new season value tuple: %s", season_value_tuple)
         self._cursor.execute("INSERT INTO seasons (prev_id, start_date, end_date, tournament_date, title, active, kicked) VALUES (?, ?, ?, ?, ?, ?, ?)", season_value_tuple)
         self._conn.commit()
+        self._invalidate_season_context()
+        self._bump_data_version()
         return self._cursor.lastrowid, None
 
     def get_db_version(self):
-        self._cursor.execute('SELECT max(id) FROM REVISIONS')
-        v = self._cursor.fetchall()
+        cursor = self._read_cursor()
+        cursor.execute('SELECT max(id) FROM REVISIONS')
+        v = cursor.fetchall()
         if not v:
             return 0
         assert len(v) == 1
@@ -256,14 +499,38 @@ class Database:
         assert len(v) == 1
         return v[0]
 
+    def _bump_data_version(self):
+        # called after every write that can change ladders, roster or matches
+        self._publish_ladder_index()
+        self._data_version = self._data_version + 1
+        self._snapshots = {}
+
+    def get_data_version(self):
+        return self._data_version
+
+    def _snapshot(self, key, build):
+        # serve the result from memory if it was built at the current data
+        # version, otherwise build and remember it; callers get their own
+        # copies of the records so the cached ones never change
+        version = self._data_version
+        entry = self._snapshots.get(key)
+        if entry and entry[0] == version:
+            records = entry[1]
+        else:
+            records = tuple(build())
+            if version == self._data_version:
+                self._snapshots[key] = (version, records)
+        return [ dict(r) for r in records ]
+
     def get_recent_matches(self, ladder, since, pending=False):
         season_id, _, _, _, _, _ = self.get_season()
         keys = { 'ladder': ladder, 'since': since, 'season_id': season_id, 'disputed': False, 'pending': pending}
-        return self.lookup_match(keys)
+        return self._snapshot(('recent_matches', ladder, since, pending), lambda: self.lookup_match(keys))
 
     def get_archived_ladder(self, season_id, ladder = None):
         if not season_id:
             return []
+        cursor = self._read_cursor()
         fields = ['player_id', 'points', 'ladder']
         fields_string = string.join(fields, ',')
         query_fields = ['active=1', 'season_id=?']
@@ -272,13 +539,17 @@ class Database:
             query_fields += ['ladder=?']
             query_values += [ladder]
         query_string = string.join(query_fields, ' and ')
-        self._log.debug("query_string={}".format(query_string))
-        self._log.debug("query_values={}".format(tuple(query_values)))
-        self._log.debug("fields_string={}".format(fields_string))
-        r = [ dict(zip(fields, record)) for record in self._cursor.execute("SELECT {} FROM player_archive WHERE {} ORDER BY ladder, points DESC".format(fields_string, query_string), tuple(query_values)) ]
+        self._log.debug("query_string=%s", query_string)
+        self._log.debug("query_values=%s", tuple(query_values))
+        self._log.debug("fields_string=%s", fields_string)
+        r = [ dict(zip(fields, record)) for record in cursor.execute("SELECT {} FROM player_archive WHERE {} ORDER BY ladder, points DESC".format(fields_string, query_string), tuple(query_values)) ]
         return r
 
     def get_ladder(self, ladder = None, player_id = None):
+        return self._snapshot(('ladder', ladder, player_id), lambda: self._get_ladder(ladder, player_id))
+
+    def _get_ladder(self, ladder, player_id):
+        cursor = self._read_cursor()
         fields = ["first_name", "last_name", "points", "id", "wins", "losses", "a_wins", "a_losses", "b_wins", "b_losses", "c_wins", "c_losses",  "tournament_qualified_override"]
         fields_string = string.join(fields, ',')
         query_fields = ['active=1']
@@ -290,69 +561,87 @@ class Database:
             query_fields += [ "id=?" ]
             query_values += [ player_id ]
         query_string = string.join(query_fields, ' and ')
-        r = [ dict(zip(fields, record)) for record in self._cursor.execute("SELECT {} FROM players WHERE {} ORDER BY points DESC".format(fields_string, query_string), tuple(query_values)) ]
-        er = [ self._expand_with_tournament_flag(record) for record in r ]
-        return er
+        r = [ dict(zip(fields, record)) for record in cursor.execute("SELECT {} FROM players WHERE {} ORDER BY points DESC".format(fields_string, query_string), tuple(query_values)) ]
+        return self._expand_with_tournament_flags(r)
 
     def ladder_changed(self, player_id, new_ladder):
         if not player_id:
             return False
-        self._cursor.execute("SELECT ladder FROM players WHERE id=?", (player_id,))
-        current_ladder = self._cursor.fetchall()[0][0]
-        self._log.debug("ladder change check: {} vs. {}".format(new_ladder, current_ladder))
+        cursor = self._read_cursor()
+        cursor.execute("SELECT ladder FROM players WHERE id=?", (player_id,))
+        current_ladder = cursor.fetchall()[0][0]
+        self._log.debug("ladder change check: %s vs. %s", new_ladder, current_ladder)
         return current_ladder != new_ladder
 
     def no_admins(self):
-        check = [ record for record in self._cursor.execute("SELECT id FROM admins") ]
+        cursor = self._read_cursor()
+        check = [ record for record in cursor.execute("SELECT id FROM admins") ]
         if len(check) == 0:
             return True
         else:
             return False
 
-    def check_password(self, username, password, table):
-        self._log.debug("check_password: {} in {}".format(username, table))
+    def get_password_hash(self, username, table):
+        cursor = self._read_cursor()
         fields = ["id", "password_hash"]
         fields_string = string.join(fields, ',')
-        r = [ dict(zip(fields, record)) for record in self._cursor.execute("SELECT {} FROM {} WHERE username=?".format(fields_string, table), (username,)) ]
+        r = [ dict(zip(fields, record)) for record in cursor.execute("SELECT {} FROM {} WHERE username=?".format(fields_string, table), (username,)) ]
         assert len(r) < 2
         if len(r) == 0:
-            self._log.debug("check_password: {} not found in {}".format(username, table))
+            self._log.debug("get_password_hash: %s not found in %s", username, table)
+            return None, None
+        else:
+            return r[0].get('id'), r[0].get('password_hash')
+
+    def check_password(self, username, password, table):
+        self._log.debug("check_password: %s in %s", username, table)
+        account_id, password_hash = self.get_password_hash(username, table)
+        if account_id == None:
             return None
+        if password_matches(password, password_hash):
+            self._log.debug("check_password: %s authenticated in %s", username, table)
+            return account_id
         else:
-            if bcrypt.hashpw(str(password), str(r[0].get('password_hash'))) == str(r[0].get('password_hash')):
-                self._log.debug("check_password: {} authenticated in {}".format(username, table))
-                return r[0].get('id')
-            else:
-                self._log.debug("check_password: {} in {} password check failed".format(username, table))
-                return None
-
-    def _expand_with_tournament_flag(self, player):
-        qualified = False
-        player_id = player.get('id')
-        qualified_override = player.get('tournament_qualified_override')
-        if player_id != None and qualified_override != None:
-            if qualified_override == 0:
-                min_matches, min_opponents, _ = self.get_tournament_parameters()
-                matches, opponents = self.get_match_and_opponent_count(player_id)
-                qualified = (matches >= min_matches and opponents >= min_opponents)
-            elif qualified_override > 0:
-                qualified = True
-        player.update({'tournament_qualified': qualified})
-        return player
+            self._log.debug("check_password: %s in %s password check failed", username, table)
+            return None
+
+    def _expand_with_tournament_flags(self, players):
+        min_matches, min_opponents, _ = self.get_tournament_parameters()
+        counts = None
+        for player in players:
+            qualified = False
+            player_id = player.get('id')
+            qualified_override = player.get('tournament_qualified_override')
+            if player_id != None and qualified_override != None:
+                if qualified_override == 0:
+                    if counts == None:
+                        counts = self.get_match_and_opponent_counts()
+                    matches, opponents = counts.get(player_id, (0, 0))
+                    qualified = (matches >= min_matches and opponents >= min_opponents)
+                elif qualified_override > 0:
+                    qualified = True
+            player.update({'tournament_qualified': qualified})
+        return players
 
     def get_roster(self):
+        return self._snapshot(('roster',), self._get_roster)
+
+    def _get_roster(self):
+        cursor = self._read_cursor()
         fields = ["first_name", "last_name", "cell_phone", "home_phone", "work_phone", "email", "id", "ladder", "company", "location", "wlocation", "tournament_qualified_override"]
         fields_string = string.join(fields, ',')
-        r = [ dict(zip(fields, record)) for record in self._cursor.execute("SELECT {} FROM players WHERE active=1 ORDER BY last_name".format(fields_string)) ]
-        er = [ self._expand_with_tournament_flag(record) for record in r ]
-        return er
+        r = [ dict(zip(fields, record)) for record in cursor.execute("SELECT {} FROM players WHERE active=1 ORDER BY last_name".format(fields_string)) ]
+        return self._expand_with_tournament_flags(r)
 
+    @_writes
     def set_init_points(self, player_id, points):
-        self._log.debug("player_id={} points={}".format(player_id, points))
+        self._log.debug("player_id=%s points=%s", player_id, points)
         self._cursor.execute("UPDATE players SET initial_points=?, points=? WHERE id=?",
                              (points, points, player_id))
         self._conn.commit()
+        self._bump_data_version()
 
+    @_writes
     def kick_season(self, prev_season, ladders = [], op_code = None):
         previous_season_ladder = []
         current_season_ladder = []
@@ -362,12 +651,12 @@ class Database:
             cur_ladder_l = self.get_ladder(l)
             init_points_l = rules.get_init_points(cur_ladder_l, prev_ladder_l)
             if op_code=='set':
-                self._log.debug("setting initial points for ladder {}".format(l))
+                self._log.debug("setting initial points for ladder %s", l)
                 assert len(cur_ladder_l) == len(init_points_l)
                 for i in range(len(cur_ladder_l)):
                     self.set_init_points(cur_ladder_l[i].get('id'), init_points_l[i])
             elif op_code=='clear':
-                self._log.debug("clearing initial points for ladder {}".format(l))
+                self._log.debug("clearing initial points for ladder %s", l)
                 for player in cur_ladder_l:
                     self.set_init_points(player.get('id'), 0)
             previous_season_ladder += prev_ladder_l
@@ -376,13 +665,21 @@ class Database:
         if op_code == 'set':
             self._cursor.execute("UPDATE seasons SET kicked=1 WHERE active=1")
             self._conn.commit()
+            self._invalidate_season_context()
+            self._bump_data_version()
         elif op_code=='clear':
             self._cursor.execute("UPDATE seasons SET kicked=0 WHERE active=1")
             self._conn.commit()
+            self._invalidate_season_context()
+            self._bump_data_version()
         return previous_season_ladder, current_season_ladder, init_points
 
+    @_writes
     def kick_if_needed(self):
         _, start_date, end_date, _, prev_id, kicked  = self.get_season()
+        if not start_date or not end_date:
+            self._log.debug("kick_if_needed: season has no date-range, skipping kick")
+            return
         present_datetime = datetime.now()
         sd = datetime.strptime(start_date, '%Y-%m-%d')
         ed = datetime.strptime(end_date, '%Y-%m-%d')
@@ -395,6 +692,7 @@ class Database:
         else:
             self._log.debug("kick_if_needed: off-season, skipping kick")
 
+    @_writes
     def update_player(self, player, player_id = None):
         # first override initial points if necessary
         reset_points = False
@@ -432,16 +730,19 @@ class Database:
             values_tuple = values_tuple + (password_hash,)
         assert(len(fields_tuple) == len(values_tuple))
         values_pattern = ('?,' * len(values_tuple))[:-1]
-        self._log.debug("update_player: fields are {}".format(fields_tuple))
-        self._log.debug("update_player: values are {}".format(values_tuple))
+        self._log.debug("update_player: fields are %s", fields_tuple)
+        self._log.debug("update_player: values are %s", values_tuple)
         check_username = player.get('username')
         if player_id == None:
             check = [ record for record in self._cursor.execute("SELECT id FROM players WHERE username=? COLLATE NOCASE", (check_username,))] + [ record for record in self._cursor.execute("SELECT id FROM admins WHERE username=? COLLATE NOCASE", (check_username,))]
             if len(check) > 0:
                 return -1, "username conflict"
             self._cursor.execute("INSERT INTO players {} VALUES ({})".format(fields_tuple, values_pattern), values_tuple)
+            player_id = self._cursor.lastrowid
+            self._update_ladder_intervals(player_id)
             self._conn.commit()
-            return self._cursor.lastrowid, None
+            self._bump_data_version()
+            return player_id, None
         else:
             check = [ record for record in self._cursor.execute("SELECT id FROM players WHERE id=?", (player_id,)) ]
             if len(check) == 0:
@@ -452,43 +753,105 @@ class Database:
             fields_string = string.join([ f + "=?" for f in fields_tuple ], ', ')
             values_tuple += (player_id,)
             self._cursor.execute("UPDATE players SET {} WHERE id=?".format(fields_string), values_tuple)
+            self._update_ladder_intervals(player_id)
             self._conn.commit()
+            self._bump_data_version()
             return player_id, None
 
-    def _lookup_something(self, fields, operator, table_name, common_fields, translated_fields, special_fields = {}):
-        tfk = tuple(t for t in translated_fields)
-        tfs = tuple(translated_fields.get(t) for t in tfk)
-        sfk = tuple(special_fields.keys())
-        api_fields = common_fields + tfk + sfk
-        select_fields = string.join(common_fields + tfs, ', ')
-        match_tuple = ()
-        where_list = []
-        for w in api_fields:
-            f = fields.get(w)
-            if f != None:
-                match_tuple = match_tuple + (f,)
+    def _keyset_clause(self, order_by, descending):
+        # rows strictly past the given values of the order_by columns,
+        # spelled out so that it doesn't need row-value support in SQLite
+        comparison = '<' if descending else '>'
+        terms = []
+        for i in range(len(order_by)):
+            equal_terms = [ '{} = ?'.format(c) for c in order_by[:i] ]
+            terms = terms + [ '(' + string.join(equal_terms + [ '{} {} ?'.format(order_by[i], comparison) ], ' AND ') + ')' ]
+        return '(' + string.join(terms, ' OR ') + ')'
+
+    def _keyset_values(self, after):
+        values = ()
+        for i in range(len(after)):
+            values = values + tuple(after[:i + 1])
+        return values
+
+    # the parts of a lookup that only depend on the table: the API fields in
+    # the order of the SELECT list, the SELECT list and, for each API field,
+    # its position and its WHERE term; a table always comes with the same
+    # translated and special fields, so the table and the common fields
+    # (which lookup_match extends) are enough to tell them apart
+    def _lookup_projection(self, table_name, common_fields, translated_fields, special_fields):
+        key = (table_name, common_fields)
+        projection = self._lookup_projections.get(key)
+        if projection == None:
+            tfk = tuple(t for t in translated_fields)
+            tfs = tuple(translated_fields.get(t) for t in tfk)
+            sfk = tuple(special_fields.keys())
+            api_fields = common_fields + tfk + sfk
+            select_fields = string.join(common_fields + tfs, ', ')
+            terms = {}
+            for i, w in enumerate(api_fields):
                 if w in sfk:
                     # special field: translates and has custom operator
-                    # safe to do without the check, because sfk has all keys and keys are invariant
                     wt = special_fields.get(w).get('field')
                     c_operator = special_fields.get(w).get('operator')
-                    self._log.debug('_lookup_something: special field: {} --> {} , {}'.format(w, wt, c_operator))
-                    where_list = where_list + ['{} {} ?'.format(wt, c_operator)]
+                    self._log.debug('_lookup_something: special field: %s --> %s , %s', w, wt, c_operator)
+                    terms[w] = (i, '{} {} ?'.format(wt, c_operator))
                 else:
                     # direct or translated field: operator is always '='
                     wt = translated_fields.get(w)
-                    where_list = where_list + ['{} = ?'.format(wt if wt else w)]
+                    terms[w] = (i, '{} = ?'.format(wt if wt else w))
+            projection = (api_fields, select_fields, terms)
+            self._lookup_projections[key] = projection
+        return projection
+
+    def _compile_lookup(self, table_name, select_fields, where_list, operator, order_by, descending, after, limit):
         where_string = string.join(where_list, ' OR ' if operator == 'or' else ' AND ')
-        self._log.debug("_lookup_something: where string is {}".format(where_string))
-        self._log.debug("_lookup_something: match tuple is {}".format(match_tuple))
-        self._log.debug("_lookup_something: select fields are {}".format(select_fields))
-        self._log.debug("_lookup_something: api fields are {}".format(api_fields))
-        self._log.debug("_lookup_something: table is {}".format(table_name))
         if where_string:
-            r = [ dict(zip(api_fields, record)) for record in self._cursor.execute("SELECT {} FROM {} WHERE {} COLLATE NOCASE".format(select_fields, table_name, where_string), match_tuple) ]
+            where_string = where_string + ' COLLATE NOCASE'
+        if after:
+            # the filters keep their COLLATE inside the parentheses, so they
+            # match the same rows with or without the keyset
+            keyset_string = self._keyset_clause(order_by, descending)
+            if where_string:
+                where_string = '{} AND ({})'.format(keyset_string, where_string)
+            else:
+                where_string = keyset_string
+        tail_string = ''
+        if order_by:
+            direction = ' DESC' if descending else ''
+            tail_string = ' ORDER BY ' + string.join([ c + direction for c in order_by ], ', ')
+        if limit:
+            tail_string = tail_string + ' LIMIT ?'
+        if where_string:
+            return "SELECT {} FROM {} WHERE {}{}".format(select_fields, table_name, where_string, tail_string)
         else:
-            r = [ dict(zip(api_fields, record)) for record in self._cursor.execute("SELECT {} FROM {}".format(select_fields, table_name)) ]
-        self._log.debug("_lookup_something: result is {}".format(r))
+            return "SELECT {} FROM {}{}".format(select_fields, table_name, tail_string)
+
+    def _lookup_something(self, fields, operator, table_name, common_fields, translated_fields, special_fields = {}, order_by = (), descending = False, after = None, limit = None):
+        cursor = self._read_cursor()
+        api_fields, select_fields, terms = self._lookup_projection(table_name, common_fields, translated_fields, special_fields)
+        # the fields to match on, in the order of the SELECT list
+        present = sorted([ w for w in fields if w in terms and fields[w] != None ], key = lambda w: terms[w][0])
+        match_tuple = tuple([ fields[w] for w in present ])
+        if after != None:
+            assert len(after) == len(order_by)
+            match_tuple = self._keyset_values(after) + match_tuple
+        if limit != None:
+            match_tuple = match_tuple + (limit,)
+        # queries are built once for each combination of fields and options
+        key = (table_name, common_fields, tuple(present), operator == 'or', order_by, descending, after != None, limit != None)
+        query = self._lookup_queries.get(key)
+        if query == None:
+            if len(self._lookup_queries) >= _max_lookup_queries:
+                self._lookup_queries = {}
+            query = self._compile_lookup(table_name, select_fields, [ terms[w][1] for w in present ], operator, order_by, descending, after != None, limit != None)
+            self._lookup_queries[key] = query
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("_lookup_something: query is %s", query)
+            self._log.debug("_lookup_something: match tuple is %s", match_tuple)
+            self._log.debug("_lookup_something: api fields are %s", api_fields)
+        r = [ dict(zip(api_fields, record)) for record in cursor.execute(query, match_tuple) ]
+        self._log.debug("_lookup_something: result is %s", r)
         return [util.purge_null_fields(e) for e in r]
 
     def lookup_player(self, fields, operator):
@@ -497,34 +860,68 @@ class Database:
             p.pop('initial_points')
         return players
 
-    def lookup_match(self, fields):
+    # order is None (whatever order SQLite returns), 'asc' or 'desc'; ordered
+    # results are sorted by date and then by match ID, so (date, match_id)
+    # of the last match returned can be passed back as after to get the
+    # next page of at most limit matches
+    def lookup_match(self, fields, order = None, after = None, limit = None):
         # ladder is special: it can be searched, but it is generated when match is added
         # so it's not listed in the common fields tuple; we add it for search
         modified_common_match_fields = self._common_match_fields + ('last_name', '`last_name:1`', )
-        res = self._lookup_something(fields, "and", "matches_with_names", modified_common_match_fields, self._translated_match_fields, self._special_match_fields)
+        order_by = ('date', 'id') if order else ()
+        res = self._lookup_something(fields, "and", "matches_with_names", modified_common_match_fields, self._translated_match_fields, self._special_match_fields, order_by = order_by, descending = (order == 'desc'), after = after, limit = limit)
         for r in res:
             r['challenger_last_name'] = r.pop('last_name')
             r['opponent_last_name'] = r.pop('`last_name:1`')
         return res
 
+    def export_matches(self, season_id = None):
+        fields = ('match_id', ) + self._common_match_fields + ('challenger_last_name', 'opponent_last_name')
+        select_fields = string.join(('id', ) + self._common_match_fields + ('last_name', '`last_name:1`'), ', ')
+        if season_id:
+            query = "SELECT {} FROM matches_with_names WHERE season_id=? ORDER BY date, id".format(select_fields)
+            values = (season_id,)
+        else:
+            query = "SELECT {} FROM matches_with_names ORDER BY season_id, date, id".format(select_fields)
+            values = ()
+        self._log.debug("export_matches: %s", query)
+        return ExportCursor(self._db_file, fields, query, values)
+
+    def export_player_archive(self, season_id = None):
+        archive_fields = ('season_id', 'player_id', 'ladder', 'points', 'initial_points', 'active', 'wins', 'losses', 'a_wins', 'a_losses', 'b_wins', 'b_losses', 'c_wins', 'c_losses', 'tournament_qualified_override')
+        fields = archive_fields + ('first_name', 'last_name')
+        select_fields = string.join([ 'player_archive.' + f for f in archive_fields ] + [ 'players.first_name', 'players.last_name' ], ', ')
+        if season_id:
+            query = "SELECT {} FROM player_archive LEFT JOIN players ON players.id = player_archive.player_id WHERE player_archive.season_id=? ORDER BY player_archive.ladder, player_archive.points DESC".format(select_fields)
+            values = (season_id,)
+        else:
+            query = "SELECT {} FROM player_archive LEFT JOIN players ON players.id = player_archive.player_id ORDER BY player_archive.season_id, player_archive.ladder, player_archive.points DESC".format(select_fields)
+            values = ()
+        self._log.debug("export_player_archive: %s", query)
+        return ExportCursor(self._db_file, fields, query, values)
+
+    @_writes
     def delete_player(self, player_id):
-        self._log.debug("delete_player: trying to delete player with ID {}".format(player_id))
+        self._log.debug("delete_player: trying to delete player with ID %s", player_id)
         try:
             self._cursor.execute("DELETE FROM players WHERE id=?", (player_id,))
+            self._update_ladder_intervals(player_id)
             self._conn.commit()
         except:
-            self._log.error("delete_player: failed to delete player with ID {}".format(player_id))
+            self._log.error("delete_player: failed to delete player with ID %s", player_id)
             return False
+        self._bump_data_version()
         return True
 
+    @_writes
     def update_account(self, account, old_username = None):
         # construct tuples for the database
         fields_tuple = ('username', 'password_hash')
         password_hash = bcrypt.hashpw(account.get('password'), bcrypt.gensalt())
         values_tuple = (account.get('username'), password_hash)
         values_pattern = ('?,' * len(values_tuple))[:-1]
-        self._log.debug("update_account: fields are {}".format(fields_tuple))
-        self._log.debug("update_account: values are {}".format(values_tuple))
+        self._log.debug("update_account: fields are %s", fields_tuple)
+        self._log.debug("update_account: values are %s", values_tuple)
         if old_username == None:
             check_username = account.get('username')
             check = [ record for record in self._cursor.execute("SELECT id FROM players WHERE username=? COLLATE NOCASE", (check_username,))] + [ record for record in self._cursor.execute("SELECT id FROM admins WHERE username=? COLLATE NOCASE", (check_username,))]
@@ -548,8 +945,9 @@ class Database:
     def lookup_account(self, fields, operator):
         return self._lookup_something(fields, operator, "admins", self._common_account_fields, self._translated_account_fields)
 
+    @_writes
     def delete_account(self, username):
-        self._log.debug("delete_account: trying to delete account {}".format(username))
+        self._log.debug("delete_account: trying to delete account %s", username)
         check = [ record for record in self._cursor.execute("SELECT id FROM admins WHERE username=?", (username,)) ]
         if len(check) == 0:
             return -1, "account not found"
@@ -560,7 +958,7 @@ class Database:
             self._conn.commit()
         except:
             err = "failed to delete account {}".format(username)
-            self._log.error("delete_account: {}".format(err))
+            self._log.error("delete_account: %s", err)
             return -1, err
         return check[0][0], None
 
@@ -598,13 +996,14 @@ class Database:
         elif winner_ladder == 'c':
             self._cursor.execute("UPDATE players SET c_promotion=? WHERE id=?", (match_date, winner_id))
 
-    def _get_conflicting_matches(self, match_date, player_id, new_ladder):
+    def _get_conflicting_matches(self, season_id, match_date, player_id, new_ladder):
         # match is conflicting with a promoted player if someone won a match after
         # the promotion date in a lower ladder than the player being promoted
+        # (promotions are reset with each new season, so only the current season matters)
         if new_ladder == 'a':
-            cm = [ r for r in self._cursor.execute("SELECT challenger_id, ladder, date FROM matches WHERE date >= ? AND opponent_id=? AND NOT winner_id=? AND ladder in ('b', 'c') and NOT disputed UNION SELECT opponent_id, ladder, date FROM matches WHERE date >= ? AND challenger_id=? and NOT winner_id=? AND ladder in ('b', 'c') AND NOT disputed", (match_date, player_id, player_id, match_date, player_id, player_id)) ]
+            cm = [ r for r in self._cursor.execute("SELECT challenger_id, ladder, date FROM matches WHERE season_id=? AND opponent_id=? AND date >= ? AND NOT winner_id=? AND ladder in ('b', 'c') and NOT disputed UNION SELECT opponent_id, ladder, date FROM matches WHERE season_id=? AND challenger_id=? AND date >= ? and NOT winner_id=? AND ladder in ('b', 'c') AND NOT disputed", (season_id, player_id, match_date, player_id, season_id, player_id, match_date, player_id)) ]
         elif new_ladder == 'b':
-            cm = [r for r in self._cursor.execute("SELECT challenger_id, ladder, date FROM matches WHERE date >= ? AND opponent_id=? AND NOT winner_id=? AND ladder='c' AND NOT disputed UNION SELECT opponent_id, ladder, date FROM matches WHERE date >= ? AND challenger_id=? and NOT winner_id=? AND ladder='c' AND NOT disputed", (match_date, player_id, player_id, match_date, player_id, player_id)) ]
+            cm = [r for r in self._cursor.execute("SELECT challenger_id, ladder, date FROM matches WHERE season_id=? AND opponent_id=? AND date >= ? AND NOT winner_id=? AND ladder='c' AND NOT disputed UNION SELECT opponent_id, ladder, date FROM matches WHERE season_id=? AND challenger_id=? AND date >= ? and NOT winner_id=? AND ladder='c' AND NOT disputed", (season_id, player_id, match_date, player_id, season_id, player_id, match_date, player_id)) ]
         else:
             cm = []
         return cm
@@ -621,70 +1020,280 @@ class Database:
         md = datetime.strptime(match_date, '%Y-%m-%d')
         present_datetime = datetime.now()
         present_date = datetime(present_datetime.year, present_datetime.month, present_datetime.day)
-        challenger_ladder = self.player_ladder_for_date(challenger_id, md)
-        opponent_ladder = self.player_ladder_for_date(opponent_id, md)
-        current_challenger_ladder = self.player_ladder_for_date(challenger_id, present_date)
-        current_opponent_ladder = self.player_ladder_for_date(opponent_id, present_date)
+        challenger_ladder, opponent_ladder, current_challenger_ladder, current_opponent_ladder = self.player_ladders_for_dates([(challenger_id, md), (opponent_id, md), (challenger_id, present_date), (opponent_id, present_date)])
         # complex set of checks, because we could have other matches that happened after
         # this one, but have been entered before it
         if self._compare_ladders(challenger_ladder, opponent_ladder) < 0 and winner_id == challenger_id:
-            self._log.info("_credit_match: promoting match for challenger_id={}, opponent_id={}".format(challenger_id, opponent_id))
-            conflicting_matches = self._get_conflicting_matches(match_date, challenger_id, opponent_ladder)
+            self._log.info("_credit_match: promoting match for challenger_id=%s, opponent_id=%s", challenger_id, opponent_id)
+            conflicting_matches = self._get_conflicting_matches(match.get('season_id'), match_date, challenger_id, opponent_ladder)
             if conflicting_matches:
-                self._log.warning("_credit_match: found conflicting matches {}".format(conflicting_matches))
+                self._log.warning("_credit_match: found conflicting matches %s", conflicting_matches)
                 err = "This is a promoting match for player ID {} that conflicts with previously reported matches. Matches that player ID {} lost in the lower ladder on later dates would be invalidated. The system can no longer accept this match. Next time, please report all your matches promptly!".format(challenger_id, challenger_id)
                 return False, err
             else:
                 self._log.info("_credit_match: no conflicting matches")
             self._record_promotion_date(match_date, challenger_id, opponent_ladder)
             if self._compare_ladders(current_challenger_ladder, opponent_ladder) == 0:
-                self._log.info("_credit_match: challenger_id={} promoted to the same ladder by some other match, credit {} points only".format(challenger_id, cpoints))
+                self._log.info("_credit_match: challenger_id=%s promoted to the same ladder by some other match, credit %s points only", challenger_id, cpoints)
                 self._add_points(challenger_id, challenger_ladder, cpoints)
             elif self._compare_ladders(current_challenger_ladder, opponent_ladder) < 0:
-                self._log.info("_credit_match: challenger_id={} promoted by this match, credit {} points and update the ladder".format(challenger_id, cpoints))
+                self._log.info("_credit_match: challenger_id=%s promoted by this match, credit %s points and update the ladder", challenger_id, cpoints)
                 self._set_points(challenger_id, cpoints)
                 self._record_new_ladder(challenger_id, opponent_ladder)
             else:
-                self._log.info("_credit_match: challenger_id={} promoted to the higher ladder by some other match, {} points are moot".format(challenger_id, cpoints))
+                self._log.info("_credit_match: challenger_id=%s promoted to the higher ladder by some other match, %s points are moot", challenger_id, cpoints)
+            # only now that both the promotion date and the ladder are in
+            self._update_ladder_intervals(challenger_id)
         else:
-            self._log.info("_credit_match: non-promoting match for challenger_id={}, opponent_id={}".format(challenger_id, opponent_id))
+            self._log.info("_credit_match: non-promoting match for challenger_id=%s, opponent_id=%s", challenger_id, opponent_id)
             if self._compare_ladders(current_challenger_ladder, opponent_ladder) <= 0:
-                self._log.info("_credit_match: crediting challenger_id={} with {} points".format(challenger_id, cpoints))
+                self._log.info("_credit_match: crediting challenger_id=%s with %s points", challenger_id, cpoints)
                 self._add_points(challenger_id, challenger_ladder, cpoints)
             else:
-                self._log.info("_credit_match: challenger_id={} promoted to the higher ladder by some other match, {} points are moot".format(challenger_id, cpoints))
+                self._log.info("_credit_match: challenger_id=%s promoted to the higher ladder by some other match, %s points are moot", challenger_id, cpoints)
         # credit the opponent and update all match counters normally
         # (opponent cannot be promoted because he/she is always in the same or higher ladder)
         if self._compare_ladders(current_opponent_ladder, opponent_ladder) <= 0:
-            self._log.info("_credit_match: crediting opponent_id={} with {} points".format(opponent_id, opoints))
+            self._log.info("_credit_match: crediting opponent_id=%s with %s points", opponent_id, opoints)
             self._add_points(opponent_id, opponent_ladder, opoints)
         else:
-            self._log.info("_credit_match: opponent_id={} promoted to the higher ladder by some other match, {} points are moot".format(opponent_id, opoints))
+            self._log.info("_credit_match: opponent_id=%s promoted to the higher ladder by some other match, %s points are moot", opponent_id, opoints)
         self._update_match_counters(match_ladder, winner_id, challenger_id, opponent_id)
         return True, None
 
+    # the match has just been credited, after all the matches credited
+    # before it; rebuild_standings replays them in this order
+    def _record_credit(self, match_id):
+        self._cursor.execute("UPDATE matches SET credited=(SELECT COALESCE(MAX(credited), 0) + 1 FROM matches) WHERE id=?", (match_id,))
+
+    @_writes
     def approve_match(self, match):
-        self._log.debug("approve_match: {}".format(match))
-        self._credit_match(match)
+        self._log.debug("approve_match: %s", match)
+        credit_success, _ = self._credit_match(match)
+        if credit_success:
+            self._record_credit(match.get('match_id'))
         self._cursor.execute('UPDATE matches set pending=? where id=?', (False, match.get('match_id')))
         self._conn.commit()
+        self._bump_data_version()
 
+    @_writes
     def dispute_match(self, match):
-        self._log.debug("dispute_match: {}".format(match))
+        self._log.debug("dispute_match: %s", match)
         self._cursor.execute('UPDATE matches set disputed=? where id=?', (True, match.get('match_id')))
         self._conn.commit()
+        self._bump_data_version()
 
+    # approves or disputes the matches in one transaction; approvals are
+    # credited in match date order so that promotions happen as they would
+    # have if the matches had been approved one by one as they were played;
+    # returns (match_id, err) for each match ID, err is None on success
+    @_writes
+    def validate_matches(self, match_ids, action):
+        errors = {}
+        matches = []
+        unique_ids = []
+        for match_id in match_ids:
+            if match_id in errors:
+                continue
+            unique_ids.append(match_id)
+            m = self.lookup_match({'match_id': match_id})
+            if m:
+                errors[match_id] = None
+                matches.append(m[0])
+            else:
+                errors[match_id] = "match not found"
+        match_ids = unique_ids
+        matches.sort(key = lambda m: (m.get('date'), m.get('match_id')))
+        try:
+            for m in matches:
+                if action == 'approve':
+                    if not m.get('pending'):
+                        err = "match already approved"
+                    elif m.get('disputed'):
+                        err = "cannot approve disputed matches"
+                    else:
+                        credit_success, err = self._credit_match(m)
+                        if credit_success:
+                            self._cursor.execute('UPDATE matches set pending=? where id=?', (False, m.get('match_id')))
+                            self._record_credit(m.get('match_id'))
+                else:
+                    if m.get('disputed'):
+                        err = "match already disputed"
+                    elif not m.get('pending'):
+                        err = "cannot dispute approved matches"
+                    else:
+                        err = None
+                        self._cursor.execute('UPDATE matches set disputed=? where id=?', (True, m.get('match_id')))
+                errors[m.get('match_id')] = err
+            self._conn.commit()
+        except:
+            self._log.error("validate_matches: failed, rolling back %s matches", len(matches))
+            self._conn.rollback()
+            self._ladder_index_pending = {}
+            raise
+        done = len([ m for m in match_ids if errors[m] == None ])
+        if done:
+            self._bump_data_version()
+        self._log.info("validate_matches: %s %s of %s matches", action, done, len(match_ids))
+        return [ (m, errors[m]) for m in match_ids ]
+
+    # the ladder each player started the season in: players that have not
+    # been promoted are still in it; for the others, the ladder of a match
+    # they played as the opponent (the match is in the opponent's ladder)
+    # before their first promotion, or else the ladder they finished the
+    # previous season in, or else the ladder below their first promotion
+    # (the promotion columns alone can't tell, a C-player that beats an
+    # A-player only gets an A-promotion date)
+    def _season_start_ladders(self, season_id, prev_season_id):
+        archived = dict(self._cursor.execute('SELECT player_id, ladder FROM player_archive WHERE season_id=?', (prev_season_id,)).fetchall())
+        first_as_opponent = {}
+        for opponent_id, match_date, ladder in self._cursor.execute('SELECT opponent_id, date, ladder FROM matches WHERE season_id=? AND NOT disputed ORDER BY date, id', (season_id,)).fetchall():
+            first_as_opponent.setdefault(opponent_id, (match_date, ladder))
+        below = {'a': 'b', 'b': 'c', 'c': 'unranked'}
+        ladders = {}
+        for player_id, ladder, a_promotion, b_promotion, c_promotion in self._cursor.execute('SELECT id, ladder, a_promotion, b_promotion, c_promotion FROM players').fetchall():
+            promotions = [ (d, l) for d, l in [(a_promotion, 'a'), (b_promotion, 'b'), (c_promotion, 'c')] if d ]
+            if not promotions:
+                ladders[player_id] = ladder
+                continue
+            # the lower ladder first if two promotions are on the same date
+            first_date, first_ladder = min(promotions, key = lambda p: (p[0], self._ladder_weights.get(p[1])))
+            match_date, match_ladder = first_as_opponent.get(player_id, (None, None))
+            if match_date != None and match_date < first_date:
+                ladders[player_id] = match_ladder
+            elif player_id in archived:
+                ladders[player_id] = archived[player_id]
+            else:
+                ladders[player_id] = below[first_ladder]
+        return ladders
+
+    # standings of the current season as they follow from its credited
+    # matches, replayed in the order they were credited (matches.credited):
+    # every player starts with the initial points, no wins or losses, no
+    # promotions and the ladder from _season_start_ladders, then each match
+    # goes through the same steps as in _credit_match, with the ladders on
+    # the match date and today worked out from the replayed promotions, so
+    # points that were moot when the match was credited stay moot; changes
+    # made to players by hand during the season (ladder moves, points set
+    # with the initial points) are not known to the replay
+    def _replay_standings(self, season_id, prev_season_id):
+        start_ladders = self._season_start_ladders(season_id, prev_season_id)
+        standings = {}
+        index = {}
+        for player_id, ladder, initial_points in self._cursor.execute('SELECT id, ladder, initial_points FROM players').fetchall():
+            s = dict.fromkeys(self._standings_fields, 0)
+            s.update({ 'ladder': start_ladders[player_id], 'points': initial_points,
+                       'a_promotion': None, 'b_promotion': None, 'c_promotion': None })
+            standings[player_id] = s
+            index[player_id] = self._ladder_index_entry(self._ladder_intervals(player_id, None, None, None, s['ladder']))
+        present_datetime = datetime.now()
+        present_date = datetime(present_datetime.year, present_datetime.month, present_datetime.day)
+        for match_id, challenger_id, opponent_id, winner_id, cpoints, opoints, match_ladder, match_date in self._cursor.execute('SELECT id, challenger_id, opponent_id, winner_id, cpoints, opoints, ladder, date FROM matches WHERE season_id=? AND credited IS NOT NULL ORDER BY credited', (season_id,)).fetchall():
+            c = standings.get(challenger_id)
+            o = standings.get(opponent_id)
+            if c == None or o == None:
+                self._log.warning("_replay_standings: match %s is between players that are gone, skipping it", match_id)
+                continue
+            md = datetime.strptime(match_date, '%Y-%m-%d')
+            challenger_ladder = self._ladder_index_lookup(index, None, challenger_id, md)
+            opponent_ladder = self._ladder_index_lookup(index, None, opponent_id, md)
+            current_challenger_ladder = self._ladder_index_lookup(index, None, challenger_id, present_date)
+            current_opponent_ladder = self._ladder_index_lookup(index, None, opponent_id, present_date)
+            if self._compare_ladders(challenger_ladder, opponent_ladder) < 0 and winner_id == challenger_id:
+                c[opponent_ladder + '_promotion'] = match_date
+                if self._compare_ladders(current_challenger_ladder, opponent_ladder) == 0:
+                    if challenger_ladder not in ["unranked", "beginner"]:
+                        c['points'] = c['points'] + cpoints
+                elif self._compare_ladders(current_challenger_ladder, opponent_ladder) < 0:
+                    c['points'] = cpoints
+                    c['ladder'] = opponent_ladder
+                index[challenger_id] = self._ladder_index_entry(self._ladder_intervals(challenger_id, c['a_promotion'], c['b_promotion'], c['c_promotion'], c['ladder']))
+            elif self._compare_ladders(current_challenger_ladder, opponent_ladder) <= 0 and challenger_ladder not in ["unranked", "beginner"]:
+                c['points'] = c['points'] + cpoints
+            if self._compare_ladders(current_opponent_ladder, opponent_ladder) <= 0 and opponent_ladder not in ["unranked", "beginner"]:
+                o['points'] = o['points'] + opoints
+            winner, loser = (c, o) if winner_id == challenger_id else (o, c)
+            winner['wins'] = winner['wins'] + 1
+            loser['losses'] = loser['losses'] + 1
+            if match_ladder in ['a', 'b', 'c']:
+                winner[match_ladder + '_wins'] = winner[match_ladder + '_wins'] + 1
+                loser[match_ladder + '_losses'] = loser[match_ladder + '_losses'] + 1
+        return standings
+
+    # recomputes ladders, points, wins and losses and promotion dates of the
+    # current season from its credited matches (see _replay_standings) and
+    # writes back the ones that differ from what is stored, unless only
+    # verifying; returns the differences as [(player_id, field, stored,
+    # rebuilt)]
+    @_writes
+    def rebuild_standings(self, verify_only = False):
+        season_id, _, _, _, prev_season_id, _ = self.get_season()
+        standings = self._replay_standings(season_id, prev_season_id)
+        fields_string = string.join(self._standings_fields, ', ')
+        differences = []
+        updates = []
+        for record in self._cursor.execute("SELECT id, {} FROM players".format(fields_string)).fetchall():
+            player_id = record[0]
+            rebuilt = standings[player_id]
+            changed = [ (player_id, f, v, rebuilt[f]) for f, v in zip(self._standings_fields, record[1:]) if v != rebuilt[f] ]
+            if changed:
+                differences += changed
+                updates.append(tuple([ rebuilt[f] for f in self._standings_fields ]) + (player_id,))
+        self._log.info("rebuild_standings: %s of %s players differ from their matches", len(updates), len(standings))
+        if updates and not verify_only:
+            try:
+                self._cursor.executemany("UPDATE players SET {} WHERE id=?".format(string.join([ f + "=?" for f in self._standings_fields ], ', ')), updates)
+                self._rebuild_ladder_intervals()
+                self._conn.commit()
+            except:
+                self._log.error("rebuild_standings: failed, rolling back")
+                self._conn.rollback()
+                self._ladder_index_pending = {}
+                raise
+            self._bump_data_version()
+        return differences
+
+    @_writes
     def add_match(self, match):
-        self._log.debug("add_match: {}".format(match))
+        r = self._add_match(match)
+        if r[0] > 0:
+            self._conn.commit()
+            self._bump_data_version()
+        return r
+
+    # adds the matches in date order (matches on the same date in the order
+    # given) and commits them all at once; results are in the order given
+    @_writes
+    def add_matches(self, matches):
+        order = sorted(range(len(matches)), key = lambda i: matches[i].get('date'))
+        results = [ None ] * len(matches)
+        try:
+            for i in order:
+                results[i] = self._add_match(matches[i])
+            self._conn.commit()
+        except:
+            self._log.error("add_matches: failed, rolling back %s matches", len(matches))
+            self._conn.rollback()
+            self._ladder_index_pending = {}
+            raise
+        added = len([ r for r in results if r[0] > 0 ])
+        if added:
+            self._bump_data_version()
+        self._log.info("add_matches: added %s of %s matches", added, len(matches))
+        return results
+
+    # does not commit, callers do
+    def _add_match(self, match):
+        self._log.debug("add_match: %s", match)
         season_id, start_date, end_date, _, _, _ = self.get_season()
         # if query came in with season_id, override it to current season, if
         # it came in without season_id, set it
         match['season_id'] = season_id
         match_date = match.get('date')
         _, _, tournament_date = self.get_tournament_parameters()
-        self._log.info("season id is {} ({}:{})".format(season_id, start_date, end_date))
-        self._log.info("match date is {}".format(match_date))
-        self._log.info("tournament date is {}".format(tournament_date))
+        self._log.info("season id is %s (%s:%s)", season_id, start_date, end_date)
+        self._log.info("match date is %s", match_date)
+        self._log.info("tournament date is %s", tournament_date)
         md = datetime.strptime(match_date, '%Y-%m-%d')
         try:
             td = datetime.strptime(tournament_date, '%Y-%m-%d')
@@ -705,7 +1314,7 @@ class Database:
         challenger_matches = len(self._cursor.fetchall()) + 1
         self._cursor.execute("SELECT id FROM matches WHERE season_id=? AND NOT disputed AND (challenger_id=? OR opponent_id=?)", (season_id, opponent_id, opponent_id))
         opponent_matches = len(self._cursor.fetchall()) + 1
-        self._log.info("match limit inputs {} {} {}".format(challenger_matches, opponent_matches, challenger_vs_opponent))
+        self._log.info("match limit inputs %s %s %s", challenger_matches, opponent_matches, challenger_vs_opponent)
         if rules.match_limit_reached(challenger_vs_opponent, challenger_matches, opponent_matches):
             return -1, None, None, 'match limit reached for this pair of players'
         # check that referred player IDs are valid
@@ -736,7 +1345,7 @@ class Database:
         match.update({'ladder': match_ladder})
         winner_last_name = challenger_last_name if winner_id == challenger_id else opponent_last_name
         loser_last_name = challenger_last_name if winner_id == opponent_id else opponent_last_name
-        self._log.debug("winner is {} from ladder {}; loser is {} from ladder {}".format(winner_last_name, winner_ladder, loser_last_name, loser_ladder))
+        self._log.debug("winner is %s from ladder %s; loser is %s from ladder %s", winner_last_name, winner_ladder, loser_last_name, loser_ladder)
         if winner_ladder in ["beginner", "unranked"] and loser_ladder in ["beginner", "unranked"]:
             return -1, None, None, "Unranked or beginner players cannot play each other"
         # update player's scores based on match outcome
@@ -748,38 +1357,55 @@ class Database:
         values_tuple = tuple([ match.get(f) for f in fields_tuple ])
         assert(len(fields_tuple) == len(values_tuple))
         values_pattern = ('?,' * len(values_tuple))[:-1]
-        self._log.debug("add_match: fields are {}".format(fields_tuple))
-        self._log.debug("add_match: values are {}".format(values_tuple))
+        self._log.debug("add_match: fields are %s", fields_tuple)
+        self._log.debug("add_match: values are %s", values_tuple)
         insert_query = "INSERT INTO matches {} VALUES ({})".format(fields_tuple, values_pattern)
-        self._log.debug("query: {}".format(insert_query))
-        self._log.debug("values: {}".format(values_tuple))
+        self._log.debug("query: %s", insert_query)
+        self._log.debug("values: %s", values_tuple)
         self._cursor.execute(insert_query, values_tuple)
-        self._conn.commit()
-        return self._cursor.lastrowid, winner_last_name, loser_last_name, None
+        match_id = self._cursor.lastrowid
+        if not match.get('pending'):
+            self._record_credit(match_id)
+        return match_id, winner_last_name, loser_last_name, None
 
     def __init__(self, db_file):
         self._log = util.get_syslog_logger("db")
         if os.path.isfile(db_file):
-            self._log.info("found database file {}".format(db_file))
+            self._log.info("found database file %s", db_file)
             new_db = False
         else:
-            self._log.info("database file not found, creating {}".format(db_file))
+            self._log.info("database file not found, creating %s", db_file)
             new_db = True
-        self._conn = sqlite3.connect(db_file)
+        self._db_file = db_file
+        self._season_context = None
+        self._season_generation = 0
+        self._data_version = 0
+        self._snapshots = {}
+        self._ladder_index = {}
+        self._ladder_index_pending = {}
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._counting = False
+        self._lookup_projections = {}
+        self._lookup_queries = {}
+        # the writer connection is used from the database executor threads
+        self._conn = sqlite3.connect(db_file, check_same_thread = False)
         self._cursor = self._conn.cursor()
+        self._cursor.execute('PRAGMA journal_mode = WAL;')
+        self._log.info("journal mode is %s", self._cursor.fetchall()[0][0])
         self._cursor.execute('PRAGMA foreign_keys = ON;')
         self._conn.commit()
         if new_db:
             db_version = 0
         else:
             db_version = self.get_db_version()
-        self._log.info("DB version is {}".format(db_version))
+        self._log.info("DB version is %s", db_version)
         v = db_version
         for t in _schema[db_version:]:
             v = v + 1
-            self._log.debug("upgrading schema to version {}".format(v))
+            self._log.debug("upgrading schema to version %s", v)
             for q in t:
-                self._log.info("  {}".format(q))
+                self._log.info("  %s", q)
                 self._cursor.execute(q)
         # hacky fixer:
         #  BOOLEAN NOT NULL DEFAULT FALSE fields won't match
@@ -795,7 +1421,10 @@ class Database:
         self._cursor.execute("UPDATE matches SET disputed=? where disputed='FALSE'", (False,))
         self._cursor.execute("UPDATE matches SET pending=? where pending='FALSE'", (False,))
         self._cursor.execute("UPDATE seasons SET kicked=? where kicked='TRUE'", (True,))
+        self._rebuild_ladder_intervals()
         self._conn.commit()
+        self._ladder_index_pending = {}
+        self._load_ladder_index()
         db_version = self.get_db_version()
         assert db_version == v
         self._common_player_fields = ( 'username', 'first_name', 'last_name', 'email', 'home_phone', 'work_phone', 'cell_phone', 'company', 'ladder', 'active', 'initial_points', 'location', 'wlocation', 'note', 'tournament_qualified_override', 'a_promotion', 'b_promotion', 'c_promotion' )
@@ -805,4 +1434,6 @@ class Database:
         self._common_match_fields = ('ladder', 'challenger_id', 'opponent_id', 'winner_id', 'cpoints', 'opoints', 'cgames', 'ogames', 'date', 'retired', 'forfeited', 'season_id', 'disputed', 'pending', 'tournament')
         self._translated_match_fields = { 'match_id' : 'id' }
         self._special_match_fields = {'since': {'field': 'date', 'operator': '>='}}
+        # what the matches of the season decide, see rebuild_standings
+        self._standings_fields = ('ladder', 'points', 'wins', 'losses', 'a_wins', 'a_losses', 'b_wins', 'b_losses', 'c_wins', 'c_losses', 'a_promotion', 'b_promotion', 'c_promotion')
         self._ladder_weights = {'a': 3, 'b': 2, 'c':1, 'unranked':0}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+import threading
+
+# upper bounds (in seconds) of the histogram buckets
+_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(labels):
+    return ','.join([ '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels ])
+
+class Histogram:
+
+    def observe(self, value):
+        for i, bound in enumerate(_buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(_buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}}} {}'.format(name, _labels(labels + [ ('le', bound) ]), cumulative))
+        lines.append('{}_bucket{{{}}} {}'.format(name, _labels(labels + [ ('le', '+Inf') ]), self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, _labels(labels), repr(self.sum)))
+        lines.append('{}_count{{{}}} {}'.format(name, _labels(labels), self.count))
+        return lines
+
+    def __init__(self):
+        self.counts = [ 0 ] * len(_buckets)
+        self.count = 0
+        self.sum = 0.0
+
+# statements that one request ran through the database, added up over all
+# of its database calls; those run on the database threads, hence the lock
+class StatementCounts:
+
+    def add(self, counts):
+        with self._lock:
+            for fingerprint, (count, seconds) in counts.items():
+                c, s = self._counts.get(fingerprint, (0, 0.0))
+                self._counts[fingerprint] = (c + count, s + seconds)
+
+    # (statements, seconds) for the whole request
+    def totals(self):
+        with self._lock:
+            return sum([ c for c, s in self._counts.values() ]), sum([ s for c, s in self._counts.values() ])
+
+    # [(count, fingerprint)] of the statements that ran more than limit
+    # times, the most repeated first
+    def repeated(self, limit):
+        with self._lock:
+            return sorted([ (c, f) for f, (c, s) in self._counts.items() if c > limit ], reverse = True)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+# request, template and database timings, kept since the server started and
+# rendered in the Prometheus text format by to_text(); database calls are
+# timed on the database threads, hence the lock
+class Metrics:
+
+    def _histogram(self, histograms, key):
+        h = histograms.get(key)
+        if h == None:
+            h = Histogram()
+            histograms[key] = h
+        return h
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    # started is False for requests that were answered before
+    # request_started() was called for them
+    def request_finished(self, handler, status, seconds, started = True):
+        with self._lock:
+            if started:
+                self._in_flight -= 1
+            self._histogram(self._requests, handler).observe(seconds)
+            self._responses[(handler, status)] = self._responses.get((handler, status), 0) + 1
+
+    def template_rendered(self, template, seconds):
+        with self._lock:
+            self._histogram(self._templates, template).observe(seconds)
+
+    def database_called(self, method, seconds):
+        with self._lock:
+            self._histogram(self._database, method).observe(seconds)
+
+    def statements_counted(self, handler, count, repeated):
+        with self._lock:
+            self._statements[handler] = self._statements.get(handler, 0) + count
+            if repeated:
+                self._repeated[handler] = self._repeated.get(handler, 0) + 1
+
+    def _counter_text(self, name, help, label, counters):
+        lines = [ '# HELP {} {}'.format(name, help), '# TYPE {} counter'.format(name) ]
+        for key in sorted(counters):
+            lines.append('{}{{{}}} {}'.format(name, _labels([ (label, key) ]), counters[key]))
+        return lines
+
+    def _histogram_text(self, name, help, label, histograms):
+        lines = [ '# HELP {} {}'.format(name, help), '# TYPE {} histogram'.format(name) ]
+        for key in sorted(histograms):
+            lines += histograms[key].lines(name, [ (label, key) ])
+        return lines
+
+    def to_text(self):
+        with self._lock:
+            lines = [ '# HELP jim_requests_in_flight Requests being handled right now.',
+                      '# TYPE jim_requests_in_flight gauge',
+                      'jim_requests_in_flight {}'.format(self._in_flight) ]
+            lines += [ '# HELP jim_responses_total Responses sent, by handler and HTTP status.',
+                       '# TYPE jim_responses_total counter' ]
+            for handler, status in sorted(self._responses):
+                lines.append('jim_responses_total{{{}}} {}'.format(_labels([ ('handler', handler), ('code', status) ]), self._responses[(handler, status)]))
+            lines += self._histogram_text('jim_request_duration_seconds', 'Time to handle a request, by handler.', 'handler', self._requests)
+            lines += self._histogram_text('jim_template_render_seconds', 'Time to render a template (pages and cached fragments).', 'template', self._templates)
+            lines += self._histogram_text('jim_database_call_seconds', 'Time spent in a Database method on a database thread.', 'method', self._database)
+            if self._statements:
+                lines += self._counter_text('jim_database_statements_total', 'SQL statements run on behalf of requests, by handler.', 'handler', self._statements)
+                lines += self._counter_text('jim_repeated_statement_requests_total', 'Requests that ran the same statement more times than allowed, by handler.', 'handler', self._repeated)
+        return '\n'.join(lines) + '\n'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = {}
+        self._responses = {}
+        self._templates = {}
+        self._database = {}
+        self._statements = {}
+        self._repeated = {}
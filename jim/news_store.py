@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+import os
+import time
+import util
+
+# news file contents kept in memory; the file is checked for changes
+# (made by hand, or by another server process) at most once every
+# check_interval seconds, so most page views don't touch the disk at all
+class NewsStore:
+
+    def _set(self, content, stamp):
+        self._stamp = stamp
+        self._content = content
+        if content:
+            self._content_list = content.split('\n')
+        else:
+            self._content_list = [ "No news today" ]
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime, st.st_size)
+        except OSError:
+            return None
+
+    def _refresh(self):
+        now = time.time()
+        if self._checked != None and now - self._checked < self._check_interval:
+            return
+        self._checked = now
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return
+        content = ""
+        if stamp != None:
+            try:
+                with open(self.path, 'r') as f:
+                    content = f.read()
+                self._log.info("read %s characters from %s", len(content), self.path)
+            except IOError as e:
+                self._log.error("cannot read %s: %s", self.path, e)
+                stamp = None
+        self._set(content, stamp)
+
+    def get_content(self):
+        self._refresh()
+        return self._content
+
+    # the news, one element per line, ready for the main menu
+    def get_content_list(self):
+        self._refresh()
+        return self._content_list
+
+    def write(self, content):
+        # rename, so that nobody ever reads a partially written file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(self.path + '.tmp', self.path)
+        self._set(content, self._stat())
+        self._checked = time.time()
+        self._log.info("wrote %s characters to %s", len(content), self.path)
+
+    def __init__(self, path, check_interval = 2):
+        self._log = util.get_syslog_logger("news_store")
+        self.path = path
+        self._check_interval = check_interval
+        self._checked = None
+        self._set("", None)
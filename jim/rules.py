@@ -89,7 +89,7 @@ def process_match(cid, oid, cgames, ogames, retired = False, forfeited = False,
                 return None, None, None, "third set played after a player already won two sets"
         else:
             return None, None, None, "invalid set score: {}".format(s)
-    _log.info("cwset={}, owset={}".format(cwset, owset))
+    _log.info("cwset=%s, owset=%s", cwset, owset)
     if cwset == 2 and owset in [0, 1]:
         # challenger won
         return cid, winner_points(), loser_points(ogames, False), None
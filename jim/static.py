@@ -0,0 +1,137 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016, Ilija Hadzic <ilijahadzic@gmail.com>
+#
+# MIT License, see LICENSE.txt for details
+
+import os
+import gzip
+import mimetypes
+import StringIO
+import tornado.web
+import util
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# files worth compressing, everything else (images mostly) is already compressed
+_compressible = ('.js', '.css', '.html', '.map', '.htc', '.txt', '.ico', '.svg')
+# (suffix, Content-Encoding) of the precompressed copies, most preferred first
+_encodings = ([('.br', 'br')] if brotli else []) + [('.gz', 'gzip')]
+# larger files are read from disk on every request instead of kept in memory
+_max_cached_size = 1024 * 1024
+
+def _gzip(data):
+    out = StringIO.StringIO()
+    # zero mtime, so that the same file always compresses to the same bytes
+    f = gzip.GzipFile(filename = '', mode = 'wb', fileobj = out, compresslevel = 9, mtime = 0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+def _brotli(data):
+    return brotli.compress(data)
+
+# content codings the client takes, leaving out the ones it refuses with q=0
+def accepted_encodings(request):
+    accepted = []
+    for e in request.headers.get("Accept-Encoding", "").split(','):
+        parts = [ p.strip() for p in e.split(';') ]
+        if 'q=0' not in parts[1:] and 'q=0.0' not in parts[1:]:
+            accepted.append(parts[0].lower())
+    return accepted
+
+# writes compressed copies (file.js.gz, file.js.br) next to each compressible
+# file under root that doesn't already have an up to date one; copies that
+# wouldn't be smaller than the original are not kept
+def precompress(root):
+    log = util.get_syslog_logger("static")
+    compressors = { '.gz': _gzip, '.br': _brotli }
+    written = 0
+    for dir, _, files in os.walk(root):
+        for f in files:
+            if os.path.splitext(f)[1] not in _compressible:
+                continue
+            path = os.path.join(dir, f)
+            mtime = os.path.getmtime(path)
+            data = None
+            for suffix, _ in _encodings:
+                variant = path + suffix
+                if os.path.isfile(variant) and os.path.getmtime(variant) >= mtime:
+                    continue
+                if data == None:
+                    with open(path, 'rb') as source:
+                        data = source.read()
+                compressed = compressors[suffix](data)
+                try:
+                    if len(compressed) >= len(data):
+                        if os.path.isfile(variant):
+                            os.remove(variant)
+                        continue
+                    # rename, so that nobody ever sees a partially written copy
+                    with open(variant + '.tmp', 'wb') as out:
+                        out.write(compressed)
+                    os.rename(variant + '.tmp', variant)
+                    written = written + 1
+                except (IOError, OSError) as e:
+                    log.warning("cannot write %s: %s", variant, e)
+    log.info("precompressed %s files under %s (%s)", written, root, ', '.join([ e for _, e in _encodings ]))
+
+# URLs made by static_url() carry a hash of the file contents in ?v=, so
+# they can be cached forever: changed content gets a different URL; other
+# requests (links in JavaScript and CSS, rules.html, ...) are revalidated
+# with the browser on every use
+#
+# when the browser accepts it, a compressed copy made by precompress() is
+# sent instead of the file; file contents are kept in memory (until the
+# file changes) rather than read from disk on every request
+class VersionedStaticFileHandler(tornado.web.StaticFileHandler):
+    # absolute path -> ((mtime, size), contents)
+    _contents = {}
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(VersionedStaticFileHandler, self).validate_absolute_path(root, absolute_path)
+        self.original_path = absolute_path
+        self.content_encoding = None
+        if absolute_path == None or os.path.splitext(absolute_path)[1] not in _compressible:
+            return absolute_path
+        accepted = accepted_encodings(self.request)
+        for suffix, encoding in _encodings:
+            variant = absolute_path + suffix
+            if encoding in accepted and os.path.isfile(variant) and os.path.getmtime(variant) >= os.path.getmtime(absolute_path):
+                self.content_encoding = encoding
+                return variant
+        return absolute_path
+
+    def get_content_type(self):
+        if self.content_encoding:
+            # type of the file itself, not of its compressed copy
+            return mimetypes.guess_type(self.original_path)[0] or "application/octet-stream"
+        return super(VersionedStaticFileHandler, self).get_content_type()
+
+    @classmethod
+    def get_content(cls, abspath, start = None, end = None):
+        st = os.stat(abspath)
+        if st.st_size > _max_cached_size:
+            return super(VersionedStaticFileHandler, cls).get_content(abspath, start, end)
+        cached = cls._contents.get(abspath)
+        if cached == None or cached[0] != (st.st_mtime, st.st_size):
+            with open(abspath, 'rb') as f:
+                cached = ((st.st_mtime, st.st_size), f.read())
+            cls._contents[abspath] = cached
+        data = cached[1]
+        if start == None and end == None:
+            return data
+        return data[start:end]
+
+    def set_extra_headers(self, path):
+        if "v" in self.request.arguments:
+            self.set_header("Cache-Control", "public, max-age={}, immutable".format(self.CACHE_MAX_AGE))
+        else:
+            self.set_header("Cache-Control", "no-cache")
+        if os.path.splitext(self.original_path)[1] in _compressible:
+            self.set_header("Vary", "Accept-Encoding")
+        if self.content_encoding:
+            self.set_header("Content-Encoding", self.content_encoding)
@@ -8,11 +8,19 @@ import tornado
 import os
 import sys
 import binascii
+import base64
+import csv
+import StringIO
 import rules
 import util
 import string
 import db
-from tornado import web, httpserver
+import async_db
+import static
+import news_store
+import metrics
+import time
+from tornado import web, httpserver, gen, stack_context
 from datetime import datetime
 from datetime import timedelta
 
@@ -24,27 +32,120 @@ _database = None
 _news = None
 _bootstrap_token = None
 _player_reports_matches = None
+_html_root = None
+_metrics = None
 _recent_days = 14
+# number of matches read from the database at a time when streaming
+_match_stream_page = 200
+# number of rows read from the database at a time by /export
+_export_chunk = 500
+# most matches accepted by one /add_matches request
+_max_bulk_matches = 1000
+# how often (in seconds) to check if the season needs to be kicked
+_kick_check_interval = 60
+# makes ETags from before a restart (when the data version starts over) stale
+_etag_nonce = binascii.b2a_hex(os.urandom(4))
+# rendered page fragments that look the same to everyone: key -> (data version, HTML)
+_fragments = {}
+# the fragment cache is emptied when it grows past this many entries
+_max_fragments = 64
+# count the SQL statements each request runs (set from the configuration)
+_query_stats = False
+# a request that runs the same statement more times than this is logged
+_query_repeat_limit = 10
+# handler whose code runs on the IOLoop thread right now, only kept (across
+# yields, by the StackContext in DynamicBaseHandler) when counting statements
+_current_handler = None
+
+class _HandlerContext:
+    def __enter__(self):
+        global _current_handler
+        self._previous = _current_handler
+        _current_handler = self._handler
+
+    def __exit__(self, type, value, traceback):
+        global _current_handler
+        _current_handler = self._previous
+
+    def __init__(self, handler):
+        self._handler = handler
+
+# called on the database threads after every call when counting statements
+def _statements_counted(handler, method, counts):
+    if handler != None:
+        handler.statements.add(counts)
 
 class BounceAllHandler(tornado.web.RequestHandler):
     def get(self, path):
-        _log.info("bounce handler: {}".format(path))
-        _log.info("request to redirect: {}".format(self.request))
+        _log.info("bounce handler: %s", path)
+        _log.info("request to redirect: %s", self.request)
         host = self.request.host.split(':')[0]
         self.redirect("https://" + host, permanent = True)
 
-class NoCacheStaticFileHandler(tornado.web.StaticFileHandler):
-    def set_extra_headers(self, path):
-        self.set_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
-        self.set_header("Pragma", "no-cache")
-        self.set_header("Expires", "0")
+# gzip for dynamic responses, level and size threshold are set from the
+# configuration in run_server; compression runs on the IOLoop thread, so
+# routes that send a lot of data can opt out with {'compress': False}
+class DynamicGZipContentEncoding(tornado.web.GZipContentEncoding):
+    def __init__(self, request):
+        super(DynamicGZipContentEncoding, self).__init__(request)
+        self._gzipping = 'gzip' in static.accepted_encodings(request)
+        self._request = request
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if not getattr(self._request, 'compress_response', True):
+            self._gzipping = False
+        status_code, headers, chunk = super(DynamicGZipContentEncoding, self).transform_first_chunk(status_code, headers, chunk, finishing)
+        # precompressed static files come with their own Vary: Accept-Encoding
+        vary = [ v.strip() for v in headers['Vary'].split(',') ]
+        headers['Vary'] = string.join([ v for i, v in enumerate(vary) if v not in vary[:i] ], ', ')
+        return status_code, headers, chunk
 
 class DynamicBaseHandler(tornado.web.RequestHandler):
     def log_request(self):
         x_real_ip = self.request.headers.get("X-Real-IP")
         remote_ip = x_real_ip or self.request.remote_ip
         username = self.current_user.get('username') or 'nobody'
-        _log.info("log_request: {}@{} {}".format(username, remote_ip, self.request))
+        _log.info("log_request: %s@%s %s", username, remote_ip, self.request)
+
+    def _execute(self, transforms, *args, **kwargs):
+        if not _query_stats:
+            return super(DynamicBaseHandler, self)._execute(transforms, *args, **kwargs)
+        # database calls made from within this context are counted as ours
+        self.statements = metrics.StatementCounts()
+        with stack_context.StackContext(lambda: _HandlerContext(self)):
+            return super(DynamicBaseHandler, self)._execute(transforms, *args, **kwargs)
+
+    def prepare(self):
+        # on_finish also runs for requests that never got here (405 and
+        # other early errors), so it has to know whether to count them out
+        self._in_flight = True
+        _metrics.request_started()
+
+    def finish(self, chunk = None):
+        if _query_stats and not self._headers_written:
+            count, seconds = self.statements.totals()
+            self.set_header("X-DB-Statements", count)
+            self.set_header("X-DB-Time", "%.1f" % (seconds * 1000))
+            self.set_header("X-DB-Repeated", len(self.statements.repeated(_query_repeat_limit)))
+        return super(DynamicBaseHandler, self).finish(chunk)
+
+    def on_finish(self):
+        seconds = self.request.request_time()
+        _metrics.request_finished(self.__class__.__name__, self.get_status(), seconds, self._in_flight)
+        _log.debug("finished: %s %s %s in %.1f ms", self.request.method, self.request.uri, self.get_status(), seconds * 1000)
+        if _query_stats:
+            count, db_seconds = self.statements.totals()
+            repeated = self.statements.repeated(_query_repeat_limit)
+            _metrics.statements_counted(self.__class__.__name__, count, repeated)
+            _log.debug("statements: %s %s ran %s in %.1f ms", self.request.method, self.request.uri, count, db_seconds * 1000)
+            for n, fingerprint in repeated:
+                _log.warning("%s %s ran the same statement %s times: %s", self.request.method, self.request.uri, n, fingerprint)
+
+    def render_string(self, template_name, **kwargs):
+        start = time.time()
+        html = super(DynamicBaseHandler, self).render_string(template_name, **kwargs)
+        _metrics.template_rendered(template_name, time.time() - start)
+        return html
 
     def finish_failure(self, err = None, status = None):
         if status:
@@ -65,12 +166,56 @@ class DynamicBaseHandler(tornado.web.RequestHandler):
             self.finish_failure("query parse error")
             return None
 
-    def initialize(self):
-        _database.kick_if_needed()
+    def initialize(self, compress = True):
+        self._in_flight = False
+        self.request.compress_response = compress
         self.set_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
         self.set_header("Pragma", "no-cache")
         self.set_header("Expires", "0")
 
+    # pages that only depend on the database, the user and the date are
+    # tagged with the data version rather than a hash of the body, so that
+    # a repeated request is answered before any work is done; callers
+    # return right away when this returns True
+    def not_modified(self):
+        if self.request.method not in ("GET", "HEAD"):
+            return False
+        self.set_header("Cache-Control", "private, no-cache")
+        self.clear_header("Pragma")
+        self.clear_header("Expires")
+        role = 'admin' if self.current_user['admin'] else 'player'
+        etag = '"{}-{}-{}-{}-{}"'.format(_etag_nonce, _database.get_data_version(), role, self.current_user['id'], datetime.now().strftime('%Y%m%d'))
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    # HTML of template rendered with the arguments returned by the load
+    # coroutine; kept until the data version changes, so that the database
+    # is not queried and the template not rendered again until then
+    @gen.coroutine
+    def render_fragment(self, key, template, load, *args):
+        global _fragments
+        version = _database.get_data_version()
+        entry = _fragments.get(key)
+        if entry and entry[0] == version:
+            raise gen.Return(entry[1])
+        kwargs = yield load(*args)
+        html = self.render_string(template, **kwargs)
+        if len(_fragments) >= _max_fragments:
+            _fragments = {}
+        _fragments[key] = (version, html)
+        raise gen.Return(html)
+
+    # the files under html_root are served from the root of the site, which
+    # tornado's static_path setting can't do (its handler would take over
+    # every URL), so point static_url() at them here
+    def static_url(self, path, include_host = None, **kwargs):
+        settings = { 'static_path': _html_root, 'static_url_prefix': '/' }
+        return static.VersionedStaticFileHandler.make_static_url(settings, path, **kwargs)
+
     def get_current_user(self):
         return { 'admin': util.bool_or_none(self.get_secure_cookie('admin')),
                  'id': util.int_or_none(self.get_secure_cookie('id')),
@@ -97,16 +242,17 @@ class RootHandler(tornado.web.RequestHandler):
         self.redirect('/login', permanent = True)
 
 class InfoBaseHandler(DynamicBaseHandler):
+    @gen.coroutine
     def active_player_or_admin(self):
         if self.current_user['admin']:
-            return True
+            raise gen.Return(True)
         else:
             player_id = self.current_user['id']
-            check_me = _database.lookup_player({'player_id': player_id, 'active': '0'}, 'and')
+            check_me = yield _database.lookup_player({'player_id': player_id, 'active': '0'}, 'and')
             if check_me:
-                return False
+                raise gen.Return(False)
             else:
-                return True
+                raise gen.Return(True)
 
     def expand_match_record(self, match):
         winner_id = match.get('winner_id')
@@ -137,32 +283,27 @@ class InfoBaseHandler(DynamicBaseHandler):
         return match
 
 class MainMenuHandler(InfoBaseHandler):
+    @gen.coroutine
     def get(self):
         self.log_request()
         if self.authorized(quiet = True):
-            if not self.active_player_or_admin():
+            active = yield self.active_player_or_admin()
+            if not active:
                 self.render('player_profile_inactive.html',
                             admin = self.current_user['admin'],
                             player_reports_matches = _player_reports_matches)
                 return
-            try:
-                with open(_news, 'r') as f:
-                    news_content = f.read()
-            except:
-                news_content = None
-            if not news_content:
-                news_content = "No news today"
-            news_content_list = news_content.split('\n')
+            news_content_list = _news.get_content_list()
             pending_matches = []
             if _player_reports_matches and not self.current_user['admin']:
                 player_ids = [ str(self.current_user['id']) ]
                 player_id = player_ids[0]
-                season_id, _, _, _, _, _ = _database.get_season()
-                ch_matches = _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': True})
-                op_matches = _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : True})
+                season_id, _, _, _, _, _ = yield _database.get_season()
+                ch_matches, op_matches = yield [ _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': True}),
+                                                 _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : True}) ]
                 pending_matches = [self.expand_match_record(r) for r in ch_matches + op_matches]
                 pending_matches.sort(lambda x, y: util.cmp_date_field(x, y))
-                _log.debug("main_menu: pending matches found: {}".format(pending_matches))
+                _log.debug("main_menu: pending matches found: %s", pending_matches)
             self.render('main_menu.html',
                         admin = self.current_user['admin'],
                         news_content_list = news_content_list,
@@ -180,12 +321,14 @@ class GenericAdminFormHandler(DynamicBaseHandler):
             self.redirect('/login')
 
 class PlayerFormRestrictedHandler(InfoBaseHandler):
+    @gen.coroutine
     def get(self):
         if self.authorized(admin = True, quiet = True):
             # admin is redirected to its own player form
             self.redirect('/player_form')
         elif self.authorized(quiet = True):
-            if not self.active_player_or_admin():
+            active = yield self.active_player_or_admin()
+            if not active:
                 self.render('player_profile_inactive.html',
                             admin = self.current_user['admin'],
                             player_reports_matches = _player_reports_matches)
@@ -216,18 +359,20 @@ class MatchFormHandler(GenericAdminFormHandler):
                          player_reports_matches = _player_reports_matches)
 
 class MatchFormRestrictedHandler(InfoBaseHandler):
+    @gen.coroutine
     def get(self):
         if self.authorized(admin = True, quiet = True):
             # admin is redirected to its own player form
             self.redirect('/match_form')
         elif self.authorized(quiet = True):
-            if not self.active_player_or_admin():
+            active = yield self.active_player_or_admin()
+            if not active:
                 self.render('player_profile_inactive.html',
                             admin = self.current_user['admin'],
                             player_reports_matches = _player_reports_matches)
                 return
             player_id = self.current_user['id']
-            matched_players = _database.lookup_player({'player_id': player_id}, 'and')
+            matched_players = yield _database.lookup_player({'player_id': player_id}, 'and')
             assert(len(matched_players) == 1)
             player_last_name = matched_players[0].get('last_name')
             self.render('match_form.html',
@@ -246,14 +391,16 @@ class SeasonFormHandler(GenericAdminFormHandler):
                          player_reports_matches = _player_reports_matches)
 
 class TournamentFormHandler(GenericAdminFormHandler):
+    @gen.coroutine
     def get(self):
-        min_matches, min_opponents, start_date = _database.get_tournament_parameters()
+        min_matches, min_opponents, start_date = yield _database.get_tournament_parameters()
         # if tournament date is None, default to season-end date
         if not start_date:
-            _, _ , start_date, _, _, _ = _database.get_season()
+            _, _ , start_date, _, _, _ = yield _database.get_season()
         start_date_3, start_date_1, start_date_2 = tuple(start_date.split('-'))
-        qualified_players = [ p for p in _database.get_roster() if p.get('tournament_qualified') ]
-        _log.info("qualified players: {}".format(qualified_players))
+        roster = yield _database.get_roster()
+        qualified_players = [ p for p in roster if p.get('tournament_qualified') ]
+        _log.info("qualified players: %s", qualified_players)
         self.generic_get('tournament_form.html',
                          admin = self.current_user['admin'],
                          player_reports_matches = _player_reports_matches,
@@ -266,15 +413,10 @@ class TournamentFormHandler(GenericAdminFormHandler):
 
 class NewsFormHandler(GenericAdminFormHandler):
     def get(self):
-        try:
-            with open(_news, 'r') as f:
-                news_content = f.read()
-        except:
-            news_content = ""
         self.generic_get('news_form.html',
                          admin = self.current_user['admin'],
                          player_reports_matches = _player_reports_matches,
-                         news_content=news_content)
+                         news_content=_news.get_content())
 
     def post(self):
         self.log_request()
@@ -282,11 +424,9 @@ class NewsFormHandler(GenericAdminFormHandler):
             return
         news_content = self.get_argument('news_content')
         try:
-            with open(_news, 'w') as f:
-                n = f.write(news_content)
-                _log.info("wrote {} characters to {}".format(n, _news))
+            _news.write(news_content)
         except:
-            _log.error("error writing to file {}".format(_news))
+            _log.error("error writing to file %s", _news.path)
         self.redirect('/main_menu')
 
 class LoginHandler(DynamicBaseHandler):
@@ -299,11 +439,13 @@ class LoginHandler(DynamicBaseHandler):
                         color = 'black',
                         please_log_in = 'Please log in')
 
+    @gen.coroutine
     def post(self):
         self.log_request()
         username = self.get_argument('name')
         password = self.get_argument('password')
-        if _database.no_admins():
+        no_admins = yield _database.no_admins()
+        if no_admins:
             # if there are no admins in the system, only accept bootstrap token
             if username == 'bootstrap' and password == _bootstrap_token:
                 self.set_secure_cookie('admin', 'True')
@@ -314,14 +456,14 @@ class LoginHandler(DynamicBaseHandler):
                 self.redirect('/login_incorrect')
         else:
             # otherwise, authenticate in a regular way
-            admin_id = _database.check_password(username, password, 'admins')
+            admin_id = yield _database.check_password(username, password, 'admins')
             if admin_id:
                 self.set_secure_cookie('admin', 'True')
                 self.set_secure_cookie('username', username)
                 self.set_secure_cookie('id', str(admin_id))
                 self.redirect('/main_menu')
             else:
-                player_id = _database.check_password(username, password, 'players')
+                player_id = yield _database.check_password(username, password, 'players')
                 if player_id:
                     self.set_secure_cookie('admin', 'False')
                     self.set_secure_cookie('username', username)
@@ -363,9 +505,11 @@ class DateHandler(DynamicBaseHandler):
                     user_string = name)
 
 class LadderHandler(InfoBaseHandler):
+    @gen.coroutine
     def get_or_post(self, args):
-        _log.debug("ladder: args {}".format(args))
-        if not self.active_player_or_admin():
+        _log.debug("ladder: args %s", args)
+        active = yield self.active_player_or_admin()
+        if not active:
             self.render('player_profile_inactive.html',
                         admin = self.current_user['admin'],
                         player_reports_matches = _player_reports_matches)
@@ -376,49 +520,68 @@ class LadderHandler(InfoBaseHandler):
         except:
             matches_since = datetime.now() - timedelta(_recent_days)
         since_str = str(matches_since).split()[0]
-        _log.info("ladder: matches_since: {}".format(since_str))
-        a_matches = [self.expand_match_record(r) for r in _database.get_recent_matches('a', since_str)]
-        b_matches = [self.expand_match_record(r) for r in _database.get_recent_matches('b', since_str)]
-        c_matches = [self.expand_match_record(r) for r in _database.get_recent_matches('c', since_str)]
-        _log.debug("ladder: A matches found: {}".format(a_matches))
-        _log.debug("ladder: B matches found: {}".format(b_matches))
-        _log.debug("ladder: C matches found: {}".format(c_matches))
-        _, _, _, season_string, _, _ = _database.get_season()
+        _log.info("ladder: matches_since: %s", since_str)
+        _, _, _, season_string, _, _ = yield _database.get_season()
+        a_matches, b_matches, c_matches, a_ladder, b_ladder, c_ladder, u_ladder = yield [
+            self.render_fragment(('matches', 'a', since_str), 'match_list.html', self.load_matches, 'a', since_str),
+            self.render_fragment(('matches', 'b', since_str), 'match_list.html', self.load_matches, 'b', since_str),
+            self.render_fragment(('matches', 'c', since_str), 'match_list.html', self.load_matches, 'c', since_str),
+            self.render_fragment(('ladder', 'a'), 'ladder_table.html', self.load_ladder, 'a', 'A'),
+            self.render_fragment(('ladder', 'b'), 'ladder_table.html', self.load_ladder, 'b', 'B'),
+            self.render_fragment(('ladder', 'c'), 'ladder_table.html', self.load_ladder, 'c', 'C'),
+            self.render_fragment(('ladder', 'unranked'), 'ladder_table.html', self.load_ladder, 'unranked', 'U') ]
         self.render('ladder.html',
                     admin = self.current_user['admin'],
                     player_reports_matches = _player_reports_matches,
                     date_string = today,
                     season_string = season_string,
-                    a_ladder = _database.get_ladder('a'),
-                    b_ladder = _database.get_ladder('b'),
-                    c_ladder = _database.get_ladder('c'),
-                    u_ladder = _database.get_ladder('unranked'),
+                    a_ladder = a_ladder,
+                    b_ladder = b_ladder,
+                    c_ladder = c_ladder,
+                    u_ladder = u_ladder,
                     a_matches = a_matches,
                     b_matches = b_matches,
                     c_matches = c_matches
                     )
 
+    @gen.coroutine
+    def load_matches(self, ladder, since):
+        recent = yield _database.get_recent_matches(ladder, since)
+        matches = [self.expand_match_record(r) for r in recent]
+        _log.debug("ladder: %s matches found: %s", ladder.upper(), matches)
+        raise gen.Return({ 'matches': matches })
+
+    @gen.coroutine
+    def load_ladder(self, ladder, label):
+        players = yield _database.get_ladder(ladder)
+        raise gen.Return({ 'players': players, 'ladder': ladder, 'label': label })
+
+    @gen.coroutine
     def get(self):
         self.log_request()
         if self.authorized(quiet = True):
+            if self.not_modified():
+                return
             args = self.get_args()
-            self.get_or_post(args)
+            yield self.get_or_post(args)
         else:
             self.redirect('/login')
 
+    @gen.coroutine
     def post(self):
         self.log_request()
         if self.authorized(quiet=True):
             month = self.get_argument('since_date_1')
             day = self.get_argument('since_date_2')
             year = self.get_argument('since_date_3')
-            self.get_or_post({'matches_since' : ["{}-{}-{}".format(year, month, day)]})
+            yield self.get_or_post({'matches_since' : ["{}-{}-{}".format(year, month, day)]})
         else:
             self.redirect('/login')
 
 class ProfileHandler(InfoBaseHandler):
+    @gen.coroutine
     def get_or_post(self, args):
-        _log.debug("profile: args {}".format(args))
+        _log.debug("profile: args %s", args)
         player_ids = args.get('player_id')
         if not player_ids:
             if self.current_user['admin']:
@@ -432,11 +595,11 @@ class ProfileHandler(InfoBaseHandler):
             self.finish_failure("only one player id, please", 400)
             return
         player_id = player_ids[0]
-        matched_players = _database.lookup_player({'player_id': player_id, 'active': '1'}, 'and')
+        matched_players = yield _database.lookup_player({'player_id': player_id, 'active': '1'}, 'and')
         if len(matched_players) == 1:
             player = matched_players[0]
         else:
-            matched_inactive_players = _database.lookup_player({'player_id': player_id, 'active': '0'}, 'and')
+            matched_inactive_players = yield _database.lookup_player({'player_id': player_id, 'active': '0'}, 'and')
             if len(matched_inactive_players) == 1:
                 self.render('player_profile_inactive.html',
                             admin = self.current_user['admin'],
@@ -444,25 +607,25 @@ class ProfileHandler(InfoBaseHandler):
             else:
                 self.finish_failure("player lookup failed", 404)
             return
-        _log.debug("player: player found: {}".format(player))
-        matched_ladder_info = _database.get_ladder(None, player_id)
+        _log.debug("player: player found: %s", player)
+        matched_ladder_info = yield _database.get_ladder(None, player_id)
         if len(matched_ladder_info) == 1:
             ladder_info = matched_ladder_info[0]
         else:
             self.finish_failure("ladder info lookup failed", 404)
             return
-        _log.debug("player: ladder info found: {}".format(ladder_info))
-        season_id, _, _, _, _, _ = _database.get_season()
-        ch_matches = _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': False})
-        op_matches = _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : False})
+        _log.debug("player: ladder info found: %s", ladder_info)
+        season_id, _, _, _, _, _ = yield _database.get_season()
+        ch_matches, op_matches = yield [ _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': False}),
+                                         _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : False}) ]
         matches = [self.expand_match_record(r) for r in ch_matches + op_matches]
         matches.sort(lambda x, y: util.cmp_date_field(x, y))
-        _log.debug("player: matches found: {}".format(matches))
-        ch_matches = _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': True})
-        op_matches = _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : True})
+        _log.debug("player: matches found: %s", matches)
+        ch_matches, op_matches = yield [ _database.lookup_match({ 'season_id': season_id, 'challenger_id': player_id, 'disputed': False, 'pending': True}),
+                                         _database.lookup_match({ 'season_id': season_id, 'opponent_id' : player_id, 'disputed': False, 'pending' : True}) ]
         pending_matches = [self.expand_match_record(r) for r in ch_matches + op_matches]
         pending_matches.sort(lambda x, y: util.cmp_date_field(x, y))
-        _log.debug("player: pending matches found: {}".format(pending_matches))
+        _log.debug("player: pending matches found: %s", pending_matches)
         player_e_mail = player.get('email')
         player_ladder = player.get('ladder').upper()
         player_company = player.get('company')
@@ -503,38 +666,47 @@ class ProfileHandler(InfoBaseHandler):
             c_ladder_matches = c_ladder_matches
         )
 
+    @gen.coroutine
     def get(self):
         self.log_request()
         if self.authorized(quiet = True):
+            if self.not_modified():
+                return
             args = self.get_args()
-            self.get_or_post(args)
+            yield self.get_or_post(args)
         else:
             self.redirect('/login')
 
+    @gen.coroutine
     def post(self):
         self.log_request()
         if self.authorized(quiet=True):
             player_id = self.get_argument('player_id')
-            self.get_or_post({'player_id' : [ player_id ]})
+            yield self.get_or_post({'player_id' : [ player_id ]})
         else:
             self.redirect('/login')
 
 class RosterHandler(InfoBaseHandler):
+    @gen.coroutine
     def get(self):
         self.log_request()
         if self.authorized(quiet = True):
-            if not self.active_player_or_admin():
+            if self.not_modified():
+                return
+            active = yield self.active_player_or_admin()
+            if not active:
                 self.render('player_profile_inactive.html',
                             admin = self.current_user['admin'],
                             player_reports_matches = _player_reports_matches)
                 return
-            _, _, _, season_string, _, _ = _database.get_season()
+            _, _, _, season_string, _, _ = yield _database.get_season()
+            roster = yield _database.get_roster()
             self.render('roster.html',
                         admin = self.current_user['admin'],
                         player_reports_matches = _player_reports_matches,
                         season_string = season_string,
                         date_string = datetime.ctime(datetime.now()),
-                        roster = _database.get_roster()
+                        roster = roster
                         )
         else:
             self.redirect('/login')
@@ -718,14 +890,16 @@ class PlayerBaseHandler(DynamicBaseHandler):
 
 class AddPlayerHandler(PlayerBaseHandler):
 
+    @gen.coroutine
     def update_database(self, player):
-        player_id, err = _database.update_player(player)
+        player_id, err = yield _database.update_player(player)
         if player_id > 0:
             player.update({'player_id': player_id})
-            return True, err
+            raise gen.Return((True, err))
         else:
-            return False, err
+            raise gen.Return((False, err))
 
+    @gen.coroutine
     def get_or_post(self, password):
         self.log_request()
         if not self.authorized(admin = True):
@@ -737,7 +911,7 @@ class AddPlayerHandler(PlayerBaseHandler):
         player = self.parse_args(args, True, password)
         if player == None:
             return
-        r, err = self.update_database(player)
+        r, err = yield self.update_database(player)
         if r:
             self.finish_success(player)
         elif err:
@@ -745,17 +919,20 @@ class AddPlayerHandler(PlayerBaseHandler):
         else:
             self.finish_failure("could not add player to the database")
 
+    @gen.coroutine
     def post(self):
         password = self.request.body
         if password:
-            self.get_or_post(password)
+            yield self.get_or_post(password)
         else:
-            self.get_or_post(None)
+            yield self.get_or_post(None)
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post(None)
+        yield self.get_or_post(None)
 
 class DelPlayerHandler(PlayerBaseHandler):
+    @gen.coroutine
     def get_or_post(self):
         self.log_request()
         if not self.authorized(admin = True):
@@ -769,21 +946,24 @@ class DelPlayerHandler(PlayerBaseHandler):
         except:
             self.finish_failure("missing or invalid player ID")
             return
-        ch_matches = _database.lookup_match({ 'challenger_id': player_id})
-        op_matches = _database.lookup_match({ 'opponent_id' : player_id})
+        ch_matches = yield _database.lookup_match({ 'challenger_id': player_id})
+        op_matches = yield _database.lookup_match({ 'opponent_id' : player_id})
         if ch_matches + op_matches:
             self.finish_failure("cannot delete players which has played matches in the past")
             return
-        if _database.delete_player(player_id):
+        deleted = yield _database.delete_player(player_id)
+        if deleted:
             self.finish_success({'player_id': player_id})
         else:
             self.finish_failure("could not delete selected player")
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
+    @gen.coroutine
     def post(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
 class UpdatePlayerHandler(PlayerBaseHandler):
 
@@ -802,10 +982,12 @@ class UpdatePlayerHandler(PlayerBaseHandler):
         if player.get('tournament_qualified_override') != None:
             player.pop('tournament_qualified_override')
 
+    @gen.coroutine
     def update_database(self, player, player_id):
         new_ladder = player.get('ladder')
-        if _database.ladder_changed(player_id, new_ladder):
-            _, season_start_date, season_end_date, _, _, _  = _database.get_season()
+        ladder_changed = yield _database.ladder_changed(player_id, new_ladder)
+        if ladder_changed:
+            _, season_start_date, season_end_date, _, _, _  = yield _database.get_season()
             ssd = datetime.strptime(season_start_date, '%Y-%m-%d')
             sed = datetime.strptime(season_end_date, '%Y-%m-%d')
             today = datetime.now()
@@ -822,7 +1004,7 @@ class UpdatePlayerHandler(PlayerBaseHandler):
             #
             # Restricting administrative moves to off-season solves the problem
             if ssd <= date <= sed:
-                return False, "administrative ladder change not allowed in mid-season"
+                raise gen.Return((False, "administrative ladder change not allowed in mid-season"))
             if new_ladder == 'a':
                 player.update({'a_promotion' : None})
                 player.update({'b_promotion' : None})
@@ -839,21 +1021,22 @@ class UpdatePlayerHandler(PlayerBaseHandler):
                 player.update({'a_promotion' : None})
                 player.update({'b_promotion' : None})
                 player.update({'c_promotion' : None})
-        player_id, err = _database.update_player(player, player_id)
+        player_id, err = yield _database.update_player(player, player_id)
         if player_id > 0:
             player.update({'player_id': player_id})
-            return True, err
+            raise gen.Return((True, err))
         else:
-            return False, err
+            raise gen.Return((False, err))
 
+    @gen.coroutine
     def get_or_post(self, password):
         self.log_request()
         if self.authorized(admin = False, quiet = True):
             if self.authorized(admin = True, quiet = True):
-                _log.info("update_player: admin user {}".format(self.current_user['id']))
+                _log.info("update_player: admin user %s", self.current_user['id'])
                 is_admin = True
             else:
-                _log.info("update_player: regular user {}".format(self.current_user['id']))
+                _log.info("update_player: regular user %s", self.current_user['id'])
                 is_admin = False
         else:
             self.finish_failure('not authorized')
@@ -876,13 +1059,13 @@ class UpdatePlayerHandler(PlayerBaseHandler):
             # force logged-in user ID if not admin
             player_id = self.current_user['id']
             self.purge_non_privileged_fields(player)
-            _log.info("purged player record: {}".format(player))
-            existing_players = _database.lookup_player({'player_id':player_id}, 'and')
+            _log.info("purged player record: %s", player)
+            existing_players = yield _database.lookup_player({'player_id':player_id}, 'and')
             assert(len(existing_players) == 1)
             existing_player = existing_players[0]
             existing_player.update(player)
             updated_player = existing_player
-        r, err = self.update_database(updated_player, player_id)
+        r, err = yield self.update_database(updated_player, player_id)
         if r:
             self.finish_success(updated_player)
         elif err:
@@ -890,21 +1073,26 @@ class UpdatePlayerHandler(PlayerBaseHandler):
         else:
             self.finish_failure("could not add player to the database")
 
+    @gen.coroutine
     def post(self):
         password = self.request.body
         if password:
-            self.get_or_post(password)
+            yield self.get_or_post(password)
         else:
-            self.get_or_post(None)
+            yield self.get_or_post(None)
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post(None)
+        yield self.get_or_post(None)
 
 class GetPlayerHandler(PlayerBaseHandler):
+    @gen.coroutine
     def get_or_post(self):
         self.log_request()
         if not self.authorized():
             return
+        if self.not_modified():
+            return
         args = self.get_args()
         if args == None:
             self.finish_failure("missing args", 400)
@@ -937,17 +1125,20 @@ class GetPlayerHandler(PlayerBaseHandler):
         elif op != 'and' and op != 'or':
             self.finish_failure("invalid search operator")
             return
-        _log.info("get_player: search operator is '{}'".format(op))
-        matched_players = _database.lookup_player(player, op)
+        _log.info("get_player: search operator is '%s'", op)
+        matched_players = yield _database.lookup_player(player, op)
         self.finish_success({'entries': matched_players})
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
+    @gen.coroutine
     def post(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
 class ValidateMatchHandler(DynamicBaseHandler):
+    @gen.coroutine
     def get(self):
         self.log_request()
         if not self.authorized(admin = True):
@@ -957,25 +1148,36 @@ class ValidateMatchHandler(DynamicBaseHandler):
             self.finish_failure("missing args", 400)
             return
         try:
-            match_id = int(args['match_id'][0])
+            all_pending = util.str_to_bool(args['all_pending'][0])
+        except:
+            all_pending = False
+        try:
+            match_ids = [ int(m) for m in args.get('match_id', []) ]
         except:
+            self.finish_failure("invalid match ID")
+            return
+        if not match_ids and not all_pending:
             self.finish_failure("missing or invalid match ID")
             return
         try:
             action = args['action'][0]
         except:
             action = 'approve'
-        matches = _database.lookup_match({'match_id': match_id})
+        if all_pending or len(match_ids) > 1:
+            yield self.validate_many(args, match_ids, all_pending, action)
+            return
+        match_id = match_ids[0]
+        matches = yield _database.lookup_match({'match_id': match_id})
         if not matches:
             self.finish_failure("match not found")
             return
-        _log.debug("got {} matches".format(len(matches)))
+        _log.debug("got %s matches", len(matches))
         assert(len(matches) == 1)
         match = matches[0]
         if action == 'approve':
             if match.get('pending'):
                 if not match.get('disputed'):
-                    _database.approve_match(match)
+                    yield _database.approve_match(match)
                     self.finish_success({'match': match, 'action': action})
                 else:
                     self.finish_failure("cannot approve disputed matches")
@@ -984,7 +1186,7 @@ class ValidateMatchHandler(DynamicBaseHandler):
         elif action == 'dispute':
             if not match.get('disputed'):
                 if match.get('pending'):
-                    _database.dispute_match(match)
+                    yield _database.dispute_match(match)
                     self.finish_success({'match': match, 'action': action})
                 else:
                     self.finish_failure("cannot dispute approved matches")
@@ -994,108 +1196,93 @@ class ValidateMatchHandler(DynamicBaseHandler):
             self.finish_failure("invalid action")
         return
 
-class AddMatchHandler(DynamicBaseHandler):
-    def update_database(self, match):
-        match_id, winner_last_name, loser_last_name, err = _database.add_match(match)
-        if match_id > 0:
-            match.update({'match_id': match_id})
-            match.update({'winner_last_name': winner_last_name})
-            match.update({'loser_last_name': loser_last_name})
-            return True, err
-        else:
-            return False, err
-
-    def get(self):
-        self.log_request()
-        if self.authorized(admin = True, quiet = True):
-            is_admin = True
-        elif self.authorized(quiet = True):
-            is_admin = False
-            if not _player_reports_matches:
-                self.finish_failure("Reporting user's mamtches coming soon. Please use E-mail until then.")
-                return
-        else:
-            self.finish_failure("not logged in", 401)
-            return
-        args = self.get_args()
-        if args == None:
-            self.finish_failure("missing args", 400)
+    # many matches at once, either the listed ones or all pending
+    # matches of the season (current unless season_id is given)
+    @gen.coroutine
+    def validate_many(self, args, match_ids, all_pending, action):
+        if action not in ['approve', 'dispute']:
+            self.finish_failure("invalid action")
             return
+        if all_pending:
+            try:
+                season_id = int(args['season_id'][0])
+            except:
+                season_id, _, _, _, _, _ = yield _database.get_season()
+            pending = yield _database.lookup_match({'season_id': season_id, 'pending': True, 'disputed': False})
+            match_ids = match_ids + [ m.get('match_id') for m in pending ]
+        results = yield _database.validate_matches(match_ids, action)
+        entries = []
+        for match_id, err in results:
+            if err:
+                entries.append({'match_id': match_id, 'result': 'failure', 'reason': err})
+            else:
+                entries.append({'match_id': match_id, 'result': 'success'})
+        self.finish_success({'entries': entries, 'action': action})
+
+class MatchBaseHandler(DynamicBaseHandler):
+    def parse_match(self, args, is_admin):
         try:
             challenger_id = int(args['challenger'][0])
         except:
-            self.finish_failure("challenger ID missing or invalid")
-            return
+            return None, "challenger ID missing or invalid"
         try:
             opponent_id = int(args['opponent'][0])
         except:
-            self.finish_failure("opponent ID missing or invalid")
-            return
+            return None, "opponent ID missing or invalid"
         try:
             cgames_str = args['cgames']
             cgames = [ int(g) for g in cgames_str ]
         except:
-            self.finish_failure("list of games won by challenger missing or invalid")
-            return
+            return None, "list of games won by challenger missing or invalid"
         try:
             ogames_str = args['ogames']
             ogames = [ int(g) for g in ogames_str ]
         except:
-            self.finish_failure("list of games won by opponent missing or invalid")
-            return
+            return None, "list of games won by opponent missing or invalid"
         try:
             forfeited = util.str_to_bool(args['forfeited'][0])
             if forfeited == None:
-                self.finish_failure("forfeited-flag must be boolean")
-                return
+                return None, "forfeited-flag must be boolean"
         except:
             forfeited = False
         try:
             retired = util.str_to_bool(args['retired'][0])
             if retired == None:
-                self.finish_failure("retired-flag must be boolean")
-                return
+                return None, "retired-flag must be boolean"
         except:
             retired = False
         try:
             tournament = util.str_to_bool(args['tournament'][0])
             if tournament == None:
-                self.finish_failure("tournament-flag must be boolean")
-                return
+                return None, "tournament-flag must be boolean"
         except:
             tournament = False
         try:
             pending = util.str_to_bool(args['pending'][0])
             if pending == None:
-                self.finish_failure("pending-flag must be boolean")
-                return
+                return None, "pending-flag must be boolean"
         except:
             pending = False
         if not pending and not is_admin:
-            self.finish_failure("regular users can only submit pending matches")
-            return
+            return None, "regular users can only submit pending matches"
         try:
             disputed = util.str_to_bool(args['disputed'][0])
             if disputed == None:
-                self.finish_failure("disputed-flag must be boolean")
-                return
+                return None, "disputed-flag must be boolean"
         except:
             disputed = False
         if disputed and not is_admin:
             # submitting matches that are disputed to begin
             # with doesn't make sense, but admin can still
             # do it for test purpose
-            self.finish_failure("new mactch should not be disputed to begin with")
-            return
+            return None, "new mactch should not be disputed to begin with"
         try:
             date = datetime.strptime(args['date'][0], '%Y-%m-%d')
         except:
-            self.finish_failure("match date missing")
-            return
+            return None, "match date missing"
         winner_id, cpoints, opoints, err = rules.process_match(challenger_id, opponent_id, cgames, ogames, retired, forfeited, date, tournament)
         if err:
-            self.finish_failure(err)
-            return
+            return None, err
         match = {'opponent_id': opponent_id,
                  'challenger_id': challenger_id,
                  'winner_id': winner_id,
@@ -1110,12 +1297,96 @@ class AddMatchHandler(DynamicBaseHandler):
                  'pending': pending,
                  'disputed': disputed
         }
-        r, err = self.update_database(match)
+        return match, None
+
+class AddMatchHandler(MatchBaseHandler):
+    @gen.coroutine
+    def update_database(self, match):
+        match_id, winner_last_name, loser_last_name, err = yield _database.add_match(match)
+        if match_id > 0:
+            match.update({'match_id': match_id})
+            match.update({'winner_last_name': winner_last_name})
+            match.update({'loser_last_name': loser_last_name})
+            raise gen.Return((True, err))
+        else:
+            raise gen.Return((False, err))
+
+    @gen.coroutine
+    def get(self):
+        self.log_request()
+        if self.authorized(admin = True, quiet = True):
+            is_admin = True
+        elif self.authorized(quiet = True):
+            is_admin = False
+            if not _player_reports_matches:
+                self.finish_failure("Reporting user's mamtches coming soon. Please use E-mail until then.")
+                return
+        else:
+            self.finish_failure("not logged in", 401)
+            return
+        args = self.get_args()
+        if args == None:
+            self.finish_failure("missing args", 400)
+            return
+        match, err = self.parse_match(args, is_admin)
+        if err:
+            self.finish_failure(err)
+            return
+        r, err = yield self.update_database(match)
         if r:
             self.finish_success(match)
         else:
             self.finish_failure(err)
 
+# takes a JSON list of matches in the POST body, each with the same fields
+# as /add_match query arguments, and reports the outcome for each one
+class AddMatchesHandler(MatchBaseHandler):
+    def match_args(self, entry):
+        args = {}
+        for f in entry:
+            v = entry[f]
+            args[f] = [ unicode(x) for x in v ] if isinstance(v, list) else [ unicode(v) ]
+        return args
+
+    @gen.coroutine
+    def post(self):
+        self.log_request()
+        if not self.authorized(admin = True):
+            return
+        try:
+            entries = tornado.escape.json_decode(self.request.body)
+            assert isinstance(entries, list)
+            assert all([ isinstance(e, dict) for e in entries ])
+        except:
+            self.finish_failure("body must be a JSON list of matches", 400)
+            return
+        if len(entries) > _max_bulk_matches:
+            self.finish_failure("at most {} matches can be added at once".format(_max_bulk_matches))
+            return
+        results = [ None ] * len(entries)
+        matches = []
+        positions = []
+        for i, e in enumerate(entries):
+            match, err = self.parse_match(self.match_args(e), True)
+            if err:
+                results[i] = { 'result': 'failure', 'reason': err }
+            else:
+                matches.append(match)
+                positions.append(i)
+        added = yield _database.add_matches(matches)
+        for i, match, r in zip(positions, matches, added):
+            match_id, winner_last_name, loser_last_name, err = r
+            if match_id > 0:
+                match.update({'result': 'success',
+                              'match_id': match_id,
+                              'winner_last_name': winner_last_name,
+                              'loser_last_name': loser_last_name})
+                results[i] = match
+            else:
+                results[i] = { 'result': 'failure', 'reason': err }
+        _log.info("add_matches: %s of %s matches added", len([ r for r in results if r['result'] == 'success' ]), len(entries))
+        self.finish_success({'entries': results})
+
 class DelMatchHandler(DynamicBaseHandler):
     def get(self):
         self.log_request()
@@ -1136,10 +1407,13 @@ class DelMatchHandler(DynamicBaseHandler):
         self.finish_success({'match_id': match_id})
 
 class GetMatchHandler(InfoBaseHandler):
+    @gen.coroutine
     def get(self):
         self.log_request()
         if not self.authorized():
             return
+        if self.not_modified():
+            return
         args = self.get_args()
         if args == None:
             self.finish_failure("missing args", 400)
@@ -1182,11 +1456,29 @@ class GetMatchHandler(InfoBaseHandler):
         try:
             season_id = int(args['season_id'][0])
         except:
-            season_id, _, _, _, _, _ = _database.get_season()
+            season_id, _, _, _, _, _ = yield _database.get_season()
         try:
             sort_by_date = args['sort_by_date'][0]
         except:
             sort_by_date = None
+        try:
+            limit = int(args['limit'][0])
+        except:
+            limit = None
+        if limit != None and limit <= 0:
+            self.finish_failure("limit must be positive")
+            return
+        try:
+            after = self.decode_match_cursor(args['after'][0])
+        except KeyError:
+            after = None
+        except:
+            self.finish_failure("invalid after cursor")
+            return
+        try:
+            stream = util.str_to_bool(args['stream'][0])
+        except:
+            stream = False
         keys =  util.purge_null_fields({ 'challenger_id': challenger_id,
                                          'opponent_id': opponent_id,
                                          'winner_id': winner_id,
@@ -1196,15 +1488,134 @@ class GetMatchHandler(InfoBaseHandler):
                                          'since': str(since).split()[0] if since else None,
                                          'pending': pending,
                                          'disputed': disputed})
-        _log.info("keys = {}".format(keys))
-        ms = _database.lookup_match(keys)
+        _log.info("keys = %s", keys)
+        # pages are in (date, match ID) order, newest first only if asked
+        order = 'desc' if sort_by_date == 'desc' else 'asc'
+        if stream:
+            yield self.stream_matches(keys, order, after, limit)
+            return
+        ms = yield _database.lookup_match(keys, order, after, limit)
         matches = [self.expand_match_record(m) for m in ms]
-        if sort_by_date:
-            if sort_by_date == 'asc':
-                matches.sort(lambda x, y: util.cmp_date_field(x, y, -1))
-            elif sort_by_date == 'desc':
-                matches.sort(lambda x, y: util.cmp_date_field(x, y))
-        self.finish_success({'entries': matches})
+        result = {'entries': matches}
+        if limit != None and len(matches) == limit:
+            result['after'] = self.encode_match_cursor(matches[-1])
+        self.finish_success(result)
+
+    def encode_match_cursor(self, match):
+        return base64.urlsafe_b64encode("{},{}".format(match.get('date'), match.get('match_id')))
+
+    def decode_match_cursor(self, cursor):
+        date, match_id = base64.urlsafe_b64decode(cursor).split(',')
+        datetime.strptime(date, '%Y-%m-%d')
+        return date, int(match_id)
+
+    # writes the same JSON document as finish_success, but a page at a
+    # time, so the response never has to be held in memory as a whole
+    @gen.coroutine
+    def stream_matches(self, keys, order, after, limit):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{"result": "success", "entries": [')
+        separator = ''
+        remaining = limit
+        last_match = None
+        while remaining == None or remaining > 0:
+            page_size = _match_stream_page if remaining == None else min(remaining, _match_stream_page)
+            ms = yield _database.lookup_match(keys, order, after, page_size)
+            if ms:
+                self.write(separator + string.join([ tornado.escape.json_encode(self.expand_match_record(m)) for m in ms ], ', '))
+                separator = ', '
+                last_match = ms[-1]
+                after = (last_match.get('date'), last_match.get('match_id'))
+                yield self.flush()
+            if remaining != None:
+                remaining = remaining - len(ms)
+            if len(ms) < page_size:
+                last_match = None
+                break
+        self.write(']')
+        if last_match and limit != None:
+            self.write(', "after": ' + tornado.escape.json_encode(self.encode_match_cursor(last_match)))
+        self.finish('}')
+
+class ExportHandler(DynamicBaseHandler):
+    def csv_rows(self, rows):
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        for r in rows:
+            writer.writerow([ v.encode('utf-8') if isinstance(v, unicode) else v for v in r ])
+        return out.getvalue()
+
+    def ndjson_rows(self, fields, rows):
+        return string.join([ tornado.escape.json_encode(dict(zip(fields, r))) + '\n' for r in rows ], '')
+
+    @gen.coroutine
+    def get(self):
+        self.log_request()
+        if not self.authorized():
+            return
+        args = self.get_args()
+        if args == None:
+            self.finish_failure("missing args", 400)
+            return
+        try:
+            table = args['table'][0]
+        except:
+            table = 'matches'
+        if table not in ['matches', 'player_archive']:
+            self.finish_failure("table must be matches or player_archive")
+            return
+        try:
+            export_format = args['format'][0].lower()
+        except:
+            export_format = 'ndjson'
+        if export_format not in ['ndjson', 'csv']:
+            self.finish_failure("format must be ndjson or csv")
+            return
+        try:
+            all_seasons = util.str_to_bool(args['all_seasons'][0])
+        except:
+            all_seasons = False
+        if all_seasons:
+            season_id = None
+        else:
+            try:
+                season_id = int(args['season_id'][0])
+            except:
+                season_id, _, _, _, _, _ = yield _database.get_season()
+        if table == 'matches':
+            export = yield _database.export_matches(season_id)
+        else:
+            export = yield _database.export_player_archive(season_id)
+        filename = "{}-{}.{}".format(table, season_id if season_id else 'all', 'csv' if export_format == 'csv' else 'json')
+        if export_format == 'csv':
+            self.set_header("Content-Type", "text/csv; charset=UTF-8")
+        else:
+            self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        self.set_header("Content-Disposition", 'attachment; filename="{}"'.format(filename))
+        rows_sent = 0
+        try:
+            if export_format == 'csv':
+                self.write(self.csv_rows([export.fields]))
+            while True:
+                rows = yield _database.fetch_export(export, _export_chunk)
+                if rows:
+                    if export_format == 'csv':
+                        self.write(self.csv_rows(rows))
+                    else:
+                        self.write(self.ndjson_rows(export.fields, rows))
+                    rows_sent = rows_sent + len(rows)
+                    # wait for the chunk to go out before reading the next
+                    # one, other requests are served in the meantime
+                    yield self.flush()
+                if len(rows) < _export_chunk:
+                    break
+        except tornado.iostream.StreamClosedError:
+            _log.info("export: client went away after %s rows", rows_sent)
+            return
+        finally:
+            yield _database.close_export(export)
+        _log.info("export: sent %s rows of %s", rows_sent, table)
+        self.finish()
 
 class UpdateMatchHandler(DynamicBaseHandler):
     def get(self):
@@ -1242,14 +1653,16 @@ class AccountBaseHandler(DynamicBaseHandler):
             return util.purge_null_fields(account), None
 
 class AddAccountHandler(AccountBaseHandler):
+    @gen.coroutine
     def update_database(self, account):
-        account_id, err = _database.update_account(account)
+        account_id, err = yield _database.update_account(account)
         if account_id > 0:
             account.update({'account_id': account_id})
-            return True, err
+            raise gen.Return((True, err))
         else:
-            return False, err
+            raise gen.Return((False, err))
 
+    @gen.coroutine
     def get_or_post(self, password):
         self.log_request()
         if not self.authorized(admin = True):
@@ -1262,23 +1675,26 @@ class AddAccountHandler(AccountBaseHandler):
         if account == None:
             self.finish_failure(err)
             return
-        r, err = self.update_database(account)
+        r, err = yield self.update_database(account)
         if r:
             self.finish_success(account)
         else:
             self.finish_failure(err)
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post(None)
+        yield self.get_or_post(None)
 
+    @gen.coroutine
     def post(self):
         password = self.request.body
         if password:
-            self.get_or_post(password)
+            yield self.get_or_post(password)
         else:
-            self.get_or_post(None)
+            yield self.get_or_post(None)
 
 class DelAccountHandler(AccountBaseHandler):
+    @gen.coroutine
     def get_or_post(self):
         self.log_request()
         if not self.authorized(admin = True):
@@ -1292,19 +1708,22 @@ class DelAccountHandler(AccountBaseHandler):
         except:
             self.finish_failure("missing or invalid username")
             return
-        r, err =  _database.delete_account(username)
+        r, err = yield _database.delete_account(username)
         if r > 0:
             self.finish_success({'account_id': r})
         else:
             self.finish_failure(err)
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
+    @gen.coroutine
     def post(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
 class GetAccountHandler(AccountBaseHandler):
+    @gen.coroutine
     def get_or_post(self):
         self.log_request()
         if not self.authorized(admin = True):
@@ -1331,25 +1750,29 @@ class GetAccountHandler(AccountBaseHandler):
         elif op != 'and' and op != 'or':
             self.finish_failure("invalid search operator")
             return
-        _log.info("get_account: search operator is '{}'".format(op))
-        matched_accounts = _database.lookup_account(account, op)
+        _log.info("get_account: search operator is '%s'", op)
+        matched_accounts = yield _database.lookup_account(account, op)
         self.finish_success({'entries': matched_accounts})
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
+    @gen.coroutine
     def post(self):
-        self.get_or_post()
+        yield self.get_or_post()
 
 class UpdateAccountHandler(AccountBaseHandler):
+    @gen.coroutine
     def update_database(self, account, username):
-        account_id, err = _database.update_account(account, username)
+        account_id, err = yield _database.update_account(account, username)
         if account_id > 0:
             account.update({'account_id': account_id})
-            return True, err
+            raise gen.Return((True, err))
         else:
-            return False, err
+            raise gen.Return((False, err))
 
+    @gen.coroutine
     def get_or_post(self, password):
         self.log_request()
         if not self.authorized(admin = True):
@@ -1364,23 +1787,26 @@ class UpdateAccountHandler(AccountBaseHandler):
             return
         username = account.get('username')
         assert username
-        r, err = self.update_database(account, username)
+        r, err = yield self.update_database(account, username)
         if r:
             self.finish_success(account)
         else:
             self.finish_failure(err)
 
+    @gen.coroutine
     def get(self):
-        self.get_or_post(None)
+        yield self.get_or_post(None)
 
+    @gen.coroutine
     def post(self):
         password = self.request.body
         if password:
-            self.get_or_post(password)
+            yield self.get_or_post(password)
         else:
-            self.get_or_post(None)
+            yield self.get_or_post(None)
 
 class UpdateTournamentHandler(DynamicBaseHandler):
+    @gen.coroutine
     def get_or_post(self, args):
         self.log_request()
         if not self.authorized(admin = True, quiet = True):
@@ -1398,26 +1824,29 @@ class UpdateTournamentHandler(DynamicBaseHandler):
             min_opponents = int(args['min_opponents'][0])
         except:
             min_opponents = None
-        _log.info("new tournament parameters: {} {}/{}".format(start_date, min_matches, min_opponents))
+        _log.info("new tournament parameters: %s %s/%s", start_date, min_matches, min_opponents)
         if start_date != None and min_matches != None and min_opponents != None:
-            _database.set_tournament_parameters(start_date, min_matches, min_opponents)
+            yield _database.set_tournament_parameters(start_date, min_matches, min_opponents)
         self.redirect('/tournament_form')
 
+    @gen.coroutine
     def get(self):
         args = self.get_args()
         if args == None:
             self.finish_failure("missing args", 400)
             return
-        self.get_or_post(args)
+        yield self.get_or_post(args)
 
+    @gen.coroutine
     def post(self):
         start_date = self.get_argument('start_date_3') + '-' + self.get_argument('start_date_1') + '-' + self.get_argument('start_date_2')
         min_matches = self.get_argument('min_matches')
         min_opponents = self.get_argument('min_opponents')
         args = {'start_date' : [start_date], 'min_matches' : [min_matches], 'min_opponents' : [min_opponents]}
-        self.get_or_post(args)
+        yield self.get_or_post(args)
 
 class KickSeasonHandler(DynamicBaseHandler):
+    @gen.coroutine
     def get(self):
         self.log_request()
         args = self.get_args()
@@ -1434,11 +1863,12 @@ class KickSeasonHandler(DynamicBaseHandler):
         ladders = args.get('ladder')
         if not ladders:
             ladders = ['a', 'b', 'c']
-        season_tuple = _database.get_season()
-        previous_season_ladder, current_season_ladder, init_points = _database.kick_season(season_tuple[4], ladders, db)
+        season_tuple = yield _database.get_season()
+        previous_season_ladder, current_season_ladder, init_points = yield _database.kick_season(season_tuple[4], ladders, db)
         self.finish_success({'args': args, 'season': season_tuple, 'previous_season_ladder': previous_season_ladder, 'current_season_ladder': current_season_ladder, 'init_points': init_points})
 
 class NewSeasonHandler(DynamicBaseHandler):
+    @gen.coroutine
     def get_or_post(self, args):
         self.log_request()
         if not self.authorized(admin = True):
@@ -1464,7 +1894,7 @@ class NewSeasonHandler(DynamicBaseHandler):
             tournament_date = str(td).split()[0]
         except:
             tournament_date = None
-        _log.info("new season requested: {} --- {} (tournament: {})".format(start_date, end_date, tournament_date))
+        _log.info("new season requested: %s --- %s (tournament: %s)", start_date, end_date, tournament_date)
         if (start_date and not end_date) or (not start_date and end_date):
             self.finish_failure("start and end date should either be both set or both blank")
             return
@@ -1477,30 +1907,33 @@ class NewSeasonHandler(DynamicBaseHandler):
                 self.finish_failure("tournament date must be within the season")
                 return
         _log.info("new season database transaction --- start")
-        season_id, err = _database.new_season(start_date, end_date, title, tournament_date)
+        season_id, err = yield _database.new_season(start_date, end_date, title, tournament_date)
         _log.info("new season database transaction --- end")
         if season_id:
-            _log.info("new season created id is {}".format(season_id))
+            _log.info("new season created id is %s", season_id)
             self.finish_success({'season_id' : season_id})
         else:
             _log.info("new season creation failure")
             self.finish_failure(err)
 
+    @gen.coroutine
     def get(self):
         args = self.get_args()
         if args == None:
             self.finish_failure("missing args", 400)
             return
-        self.get_or_post(args)
+        yield self.get_or_post(args)
 
+    @gen.coroutine
     def post(self):
         start_date = self.get_argument('start_date')
         end_date = self.get_argument('end_date')
         title = self.get_argument('title')
         args = {'start_date' : [start_date], 'end_date' : [end_date], 'title' : [title]}
-        self.get_or_post(args)
+        yield self.get_or_post(args)
 
 class PlayerLadderOnDateHandler(DynamicBaseHandler):
+    @gen.coroutine
     def get(self):
         if not self.authorized(admin = True):
             return
@@ -1518,36 +1951,63 @@ class PlayerLadderOnDateHandler(DynamicBaseHandler):
         except:
             self.finish_failure('missing or invalid player_id')
             return
-        _log.info("checking player {} ladder on date {}".format(player_id, date))
-        ladder = _database.player_ladder_for_date(player_id, date)
+        _log.info("checking player %s ladder on date %s", player_id, date)
+        ladder = yield _database.player_ladder_for_date(player_id, date)
         self.finish_success({'player_id': player_id, 'date': str(date).split()[0],
                              'ladder': ladder})
 
-def run_server(ssl_options = util.test_ssl_options, http_port = 80, https_port = 443, bounce_port = 8000, html_root = sys.prefix + '/var/jim/html', template_root = sys.prefix + '/var/jim/templates', database = sys.prefix + './jim.db', news = sys.prefix + './news.txt', bootstrap_token = 'deadbeef', player_reports_matches = False, autoreload = False):
-    global _http_server
-    global _https_server
-    global _bounce_server
+# recomputes the standings of the current season from its approved matches;
+# with verify=true only reports where the stored standings differ
+class RebuildStandingsHandler(DynamicBaseHandler):
+    @gen.coroutine
+    def get(self):
+        self.log_request()
+        if not self.authorized(admin = True):
+            return
+        args = self.get_args()
+        if args == None:
+            self.finish_failure("missing args", 400)
+            return
+        verify_only = util.str_to_bool(args.get('verify', ['false'])[0])
+        if verify_only == None:
+            self.finish_failure("verify must be true or false")
+            return
+        differences = yield _database.rebuild_standings(verify_only)
+        _log.info("rebuild standings (verify only: %s): %s differences", verify_only, len(differences))
+        self.finish_success({'verify': verify_only, 'differences': [ {'player_id': p, 'field': f, 'stored': old, 'rebuilt': new} for p, f, old, new in differences ]})
+
+# request, template and database timings in the Prometheus text format
+class MetricsHandler(DynamicBaseHandler):
+    def get(self):
+        self.log_request()
+        if not self.authorized(admin = True):
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.set_header("Cache-Control", "no-store")
+        self.finish(_metrics.to_text())
+
+@gen.coroutine
+def kick_season_if_needed():
+    try:
+        yield _database.kick_if_needed()
+    except Exception as e:
+        _log.error("season kick check failed: %s", e)
+
+# builds the application (handlers, templates, database threads) without
+# creating any servers; run_server() serves it and bench.http_load drives it
+def make_app(html_root = sys.prefix + '/var/jim/html', template_root = sys.prefix + '/var/jim/templates', database = None, news = './news.txt', bootstrap_token = 'deadbeef', player_reports_matches = False, db_threads = 4, password_threads = 2, compress_level = 6, compress_min_length = 1024, query_stats = False, query_repeat_limit = 10):
     global _log
     global _database
     global _news
     global _bootstrap_token
     global _player_reports_matches
+    global _html_root
+    global _metrics
+    global _query_stats
+    global _query_repeat_limit
 
-    # if some bozo calls us with None specified as an argument
-    if template_root == None:
-        template_root = sys.prefix + '/var/jim/templates'
-    if html_root == None:
-        html_root = sys.prefix + '/var/jim/html'
     if database == None:
-        database =  db.Database('./jim.db')
-    if news == None:
-        news = './news.txt'
-    if bootstrap_token == None:
-        bootstrap_token = 'deadbeef'
-    if player_reports_matches == None:
-        player_reports_matches = False
-    if autoreload == None:
-        autoreload = False
+        database = db.Database('./jim.db')
 
     # list handlers for REST calls here
     handlers = [
@@ -1565,8 +2025,10 @@ def run_server(ssl_options = util.test_ssl_options, http_port = 80, https_port =
         ('/player_ladder_on_date', PlayerLadderOnDateHandler),
         ('/update_player', UpdatePlayerHandler),
         ('/add_match', AddMatchHandler),
+        ('/add_matches', AddMatchesHandler),
         ('/del_match', DelMatchHandler),
         ('/get_match', GetMatchHandler),
+        ('/export', ExportHandler, {'compress': False}),
         ('/validate_match', ValidateMatchHandler),
         ('/update_match', UpdateMatchHandler),
         ('/add_account', AddAccountHandler),
@@ -1576,6 +2038,7 @@ def run_server(ssl_options = util.test_ssl_options, http_port = 80, https_port =
         ('/update_tournament', UpdateTournamentHandler),
         ('/new_season', NewSeasonHandler),
         ('/kick_season', KickSeasonHandler),
+        ('/rebuild_standings', RebuildStandingsHandler),
         ('/main_menu', MainMenuHandler),
         ('/match_form', MatchFormHandler),
         ('/match_form_restricted', MatchFormRestrictedHandler),
@@ -1584,27 +2047,85 @@ def run_server(ssl_options = util.test_ssl_options, http_port = 80, https_port =
         ('/tournament_form', TournamentFormHandler),
         ('/season_form', SeasonFormHandler),
         ('/news_form', NewsFormHandler),
-        ('/account_form', AccountFormHandler)
+        ('/account_form', AccountFormHandler),
+        ('/metrics', MetricsHandler)
         ]
 
     _bootstrap_token = bootstrap_token
     _log = util.get_syslog_logger("web")
-    _database = database
-    _news = news
+    _metrics = metrics.Metrics()
+    _query_stats = query_stats
+    _query_repeat_limit = query_repeat_limit
+    if query_stats:
+        _log.info("counting statements per request, repeated more than %s times are logged", query_repeat_limit)
+        _database = async_db.AsyncDatabase(database, db_threads, password_threads, _metrics.database_called, _statements_counted, lambda: _current_handler)
+    else:
+        _database = async_db.AsyncDatabase(database, db_threads, password_threads, _metrics.database_called)
+    _news = news_store.NewsStore(news)
     _player_reports_matches = player_reports_matches
-    _log.info("news file: {}".format(_news))
-    handlers.append(('/(.*)', NoCacheStaticFileHandler, {'path': html_root}))
+    _log.info("news file: %s", _news.path)
+    _html_root = html_root
+    static.precompress(html_root)
+    handlers.append(('/(.*)', static.VersionedStaticFileHandler, {'path': html_root}))
+    if compress_level > 0:
+        _log.info("compressing dynamic responses of %s bytes or more at level %s", compress_min_length, compress_level)
+        DynamicGZipContentEncoding.GZIP_LEVEL = compress_level
+        DynamicGZipContentEncoding.MIN_LENGTH = compress_min_length
+        transforms = [ DynamicGZipContentEncoding ]
+    else:
+        transforms = []
     app = tornado.web.Application(handlers = handlers, template_path = template_root,
-                                  cookie_secret = binascii.b2a_hex(os.urandom(32)))
+                                  cookie_secret = binascii.b2a_hex(os.urandom(32)),
+                                  transforms = transforms)
+    return app
+
+def run_server(ssl_options = util.test_ssl_options, http_port = 80, https_port = 443, bounce_port = 8000, html_root = sys.prefix + '/var/jim/html', template_root = sys.prefix + '/var/jim/templates', database = sys.prefix + './jim.db', news = sys.prefix + './news.txt', bootstrap_token = 'deadbeef', player_reports_matches = False, autoreload = False, db_threads = 4, password_threads = 2, compress_level = 6, compress_min_length = 1024, query_stats = False, query_repeat_limit = 10):
+    global _http_server
+    global _https_server
+    global _bounce_server
+
+    # if some bozo calls us with None specified as an argument
+    if template_root == None:
+        template_root = sys.prefix + '/var/jim/templates'
+    if html_root == None:
+        html_root = sys.prefix + '/var/jim/html'
+    if database == None:
+        database =  db.Database('./jim.db')
+    if news == None:
+        news = './news.txt'
+    if bootstrap_token == None:
+        bootstrap_token = 'deadbeef'
+    if player_reports_matches == None:
+        player_reports_matches = False
+    if autoreload == None:
+        autoreload = False
+    if db_threads == None:
+        db_threads = 4
+    if password_threads == None:
+        password_threads = 2
+    if compress_level == None:
+        compress_level = 6
+    if compress_min_length == None:
+        compress_min_length = 1024
+    if query_stats == None:
+        query_stats = False
+    if query_repeat_limit == None:
+        query_repeat_limit = 10
+
+    app = make_app(html_root = html_root, template_root = template_root, database = database, news = news, bootstrap_token = bootstrap_token, player_reports_matches = player_reports_matches, db_threads = db_threads, password_threads = password_threads, compress_level = compress_level, compress_min_length = compress_min_length, query_stats = query_stats, query_repeat_limit = query_repeat_limit)
     app_bounce = tornado.web.Application(handlers = [('/(.*)', BounceAllHandler)])
     _log.info("creating servers")
     _http_server = tornado.httpserver.HTTPServer(app, no_keep_alive = False)
     _https_server = tornado.httpserver.HTTPServer(app, no_keep_alive = False, ssl_options = ssl_options)
     _bounce_server = tornado.httpserver.HTTPServer(app_bounce)
-    _log.info("setting up TCP ports: http={}, https={}, bounce={}".format(http_port, https_port, bounce_port))
+    _log.info("setting up TCP ports: http=%s, https=%s, bounce=%s", http_port, https_port, bounce_port)
     _http_server.listen(http_port)
     _https_server.listen(https_port)
     _bounce_server.listen(bounce_port)
+    _log.info("scheduling season kick check every %s seconds", _kick_check_interval)
+    database.kick_if_needed()
+    kick_timer = tornado.ioloop.PeriodicCallback(kick_season_if_needed, _kick_check_interval * 1000)
+    kick_timer.start()
     _log.info("starting server loop")
     if autoreload:
         from tornado import autoreload
@@ -47,8 +47,8 @@ setup(
         'Programming Language :: Python :: 2.7'
     ],
     keywords='tennis rankings competition database web',
-    packages=find_packages(exclude=[]),
-    install_requires=['tornado', 'bcrypt', 'python-daemon', 'argparse'],
+    packages=find_packages(exclude=['bench', 'bench.*']),
+    install_requires=['tornado', 'bcrypt', 'python-daemon', 'argparse', 'futures'],
     package_data={
         'jim': ['jim.cfg']
     },
@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+#
+# Prints the SQLite query plan for the match queries that the server runs
+# most often and complains about any of them that scans the whole matches
+# table instead of using an index. Run it against a copy of the production
+# database after a schema change to make sure the indexes are still used.
+
+import re
+import sys
+import sqlite3
+
+if len(sys.argv) < 2:
+    print("usage: {} <database>".format(sys.argv[0]))
+    exit(1)
+
+database = sys.argv[1]
+print("using database {}".format(database))
+
+select_fields = "ladder, challenger_id, opponent_id, winner_id, cpoints, opoints, cgames, ogames, date, retired, forfeited, season_id, disputed, pending, tournament, last_name, `last_name:1`, id"
+
+# (description, query, values) for the queries as the server issues them
+queries = [
+    ("lookup_match by challenger",
+     "SELECT {} FROM matches_with_names WHERE challenger_id = ? AND season_id = ? AND disputed = ? AND pending = ? COLLATE NOCASE".format(select_fields),
+     (1, 1, False, False)),
+    ("lookup_match by opponent",
+     "SELECT {} FROM matches_with_names WHERE opponent_id = ? AND season_id = ? AND disputed = ? AND pending = ? COLLATE NOCASE".format(select_fields),
+     (1, 1, False, False)),
+    ("lookup_match pending for season",
+     "SELECT {} FROM matches_with_names WHERE season_id = ? AND disputed = ? AND pending = ? COLLATE NOCASE".format(select_fields),
+     (1, False, True)),
+    ("get_recent_matches",
+     "SELECT {} FROM matches_with_names WHERE ladder = ? AND season_id = ? AND disputed = ? AND pending = ? AND date >= ? COLLATE NOCASE".format(select_fields),
+     ('a', 1, False, False, '2000-01-01')),
+    ("add_match pair limit",
+     "SELECT id FROM matches WHERE season_id=? AND NOT disputed AND ((challenger_id=? AND opponent_id=?) OR (challenger_id=? AND opponent_id=?))",
+     (1, 1, 2, 2, 1)),
+    ("add_match player limit",
+     "SELECT id FROM matches WHERE season_id=? AND NOT disputed AND (challenger_id=? OR opponent_id=?)",
+     (1, 1, 1)),
+    ("get_match_and_opponent_count",
+     "SELECT COUNT(*) FROM (SELECT opponent_id FROM matches WHERE challenger_id=? AND season_id=? AND NOT disputed AND NOT pending UNION SELECT challenger_id FROM matches WHERE opponent_id=? AND season_id=? AND NOT disputed and NOT pending)",
+     (1, 1, 1, 1)),
+    ("get_match_and_opponent_counts",
+     "SELECT player_id, COUNT(*), COUNT(DISTINCT other_id) FROM (SELECT challenger_id AS player_id, opponent_id AS other_id FROM matches WHERE season_id=? AND NOT disputed AND NOT pending UNION ALL SELECT opponent_id, challenger_id FROM matches WHERE season_id=? AND NOT disputed AND NOT pending) GROUP BY player_id",
+     (1, 1)),
+    ("_get_conflicting_matches",
+     "SELECT challenger_id, ladder, date FROM matches WHERE season_id=? AND opponent_id=? AND date >= ? AND NOT winner_id=? AND ladder in ('b', 'c') and NOT disputed UNION SELECT opponent_id, ladder, date FROM matches WHERE season_id=? AND challenger_id=? AND date >= ? and NOT winner_id=? AND ladder in ('b', 'c') AND NOT disputed",
+     (1, 1, '2000-01-01', 1, 1, 1, '2000-01-01', 1)),
+]
+
+# full scan shows up as "SCAN TABLE matches" or "SCAN matches" depending
+# on SQLite version, index use is always reported with "USING"
+full_scan = re.compile(r'SCAN (TABLE )?matches\b(?!.*USING)')
+
+db_handle = sqlite3.connect(database)
+db = db_handle.cursor()
+
+scans = 0
+for description, query, values in queries:
+    print("{}:".format(description))
+    for row in db.execute("EXPLAIN QUERY PLAN " + query, values):
+        detail = row[-1]
+        if full_scan.search(detail):
+            scans = scans + 1
+            print("  {}  <-- full table scan".format(detail))
+        else:
+            print("  {}".format(detail))
+
+if scans:
+    print("{} full table scan(s) of matches found".format(scans))
+    exit(1)
+print("all match queries use indexes")